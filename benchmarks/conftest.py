@@ -0,0 +1,58 @@
+from flask import Blueprint, Flask
+from flask_marshmallow import Marshmallow
+
+from apifairy import APIFairy, arguments, body, response, other_responses
+
+ma = Marshmallow()
+
+
+class ItemSchema(ma.Schema):
+    id = ma.Integer(dump_only=True)
+    name = ma.Str(required=True)
+    price = ma.Float()
+    tags = ma.List(ma.Str())
+
+
+class QuerySchema(ma.Schema):
+    page = ma.Integer(load_default=1)
+    per_page = ma.Integer(load_default=10)
+
+
+def create_app():
+    app = Flask(__name__)
+    app.config['APIFAIRY_TITLE'] = 'Benchmark'
+    app.config['APIFAIRY_VERSION'] = '1.0'
+    ma.init_app(app)
+    apifairy = APIFairy(app)
+    return app, apifairy
+
+
+def create_items(count):
+    return [{'id': i, 'name': f'item {i}', 'price': i * 1.5,
+             'tags': ['foo', 'bar']} for i in range(count)]
+
+
+def create_synthetic_app(routes, blueprints=10):
+    """Return an application with the given number of documented routes,
+    spread over several blueprints."""
+    app, apifairy = create_app()
+    bps = [Blueprint(f'bp{i}', __name__) for i in range(blueprints)]
+    for i in range(routes):
+        bp = bps[i % blueprints]
+
+        @arguments(QuerySchema)
+        @body(ItemSchema)
+        @response(ItemSchema, status_code=201)
+        @other_responses({404: 'Not found'})
+        def view(query, item, id):
+            """Update an item.
+
+            Detailed description of the endpoint.
+            """
+            return item
+
+        bp.add_url_rule(f'/items{i}/<int:id>', f'view{i}', view,
+                        methods=['POST'])
+    for bp in bps:
+        app.register_blueprint(bp, url_prefix=f'/{bp.name}')
+    return app, apifairy
@@ -0,0 +1,27 @@
+"""OpenAPI specification generation benchmarks."""
+import pytest
+
+from .conftest import create_synthetic_app
+
+
+@pytest.mark.parametrize('routes', [10, 100, 1000])
+def test_generate_apispec(benchmark, routes):
+    app, apifairy = create_synthetic_app(routes)
+
+    def generate():
+        with app.test_request_context():
+            return apifairy._build_apispec()
+
+    spec = benchmark.pedantic(generate, rounds=5, warmup_rounds=1)
+    assert len(spec['paths']) == routes
+
+
+@pytest.mark.parametrize('routes', [10, 100, 1000])
+def test_apispec_endpoint(benchmark, routes):
+    app, _ = create_synthetic_app(routes)
+    client = app.test_client()
+    client.get('/apispec.json')
+
+    rv = benchmark(client.get, '/apispec.json',
+                   headers={'Accept-Encoding': 'gzip'})
+    assert rv.status_code == 200
@@ -0,0 +1,72 @@
+"""Request round trip benchmarks, measured through Flask's test client."""
+from flask import jsonify, request
+import pytest
+
+from apifairy import arguments, body, response
+
+from .conftest import create_app, create_items, ItemSchema, QuerySchema
+
+SIZES = [1, 100, 1000]
+
+
+def test_raw_flask(benchmark):
+    app, _ = create_app()
+
+    @app.route('/items/<int:id>', methods=['POST'])
+    def update_item(id):
+        page = request.args.get('page', 1, type=int)
+        item = request.get_json()
+        return jsonify({'id': id + page, 'name': item['name']})
+
+    client = app.test_client()
+    rv = benchmark(client.post, '/items/1?page=2', json={'name': 'foo'})
+    assert rv.status_code == 200
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+def test_apifairy(benchmark, compiled):
+    app, _ = create_app()
+
+    @app.route('/items/<int:id>', methods=['POST'])
+    @arguments(QuerySchema, compiled=compiled)
+    @body(ItemSchema)
+    @response(ItemSchema, compiled=compiled)
+    def update_item(query, item, id):
+        return {'id': id + query['page'], 'name': item['name']}
+
+    client = app.test_client()
+    rv = benchmark(client.post, '/items/1?page=2', json={'name': 'foo'})
+    assert rv.status_code == 200
+
+
+@pytest.mark.parametrize('size', SIZES)
+def test_body(benchmark, size):
+    app, _ = create_app()
+
+    @app.route('/items', methods=['POST'])
+    @body(ItemSchema(many=True))
+    def create_items_view(items):
+        return {'count': len(items)}
+
+    client = app.test_client()
+    items = create_items(size)
+    for item in items:
+        del item['id']
+    rv = benchmark(client.post, '/items', json=items)
+    assert rv.json == {'count': size}
+
+
+@pytest.mark.parametrize('compiled', [False, True])
+@pytest.mark.parametrize('size', SIZES)
+def test_response(benchmark, size, compiled):
+    app, _ = create_app()
+    items = create_items(size)
+
+    @app.route('/items')
+    @response(ItemSchema(many=True), compiled=compiled)
+    def get_items():
+        return items
+
+    client = app.test_client()
+    rv = benchmark(client.get, '/items')
+    assert len(rv.json) == size
@@ -1,4 +1,4 @@
 from .core import APIFairy  # noqa: F401
 from .decorators import authenticate, arguments, body, response, \
-    other_responses, webhook  # noqa: F401
+    paginated_response, other_responses, webhook  # noqa: F401
 from .fields import FileField  # noqa: F401
@@ -0,0 +1,67 @@
+from hashlib import sha256
+import mimetypes
+import os
+
+# the files needed by each documentation UI, with the CDN URLs from where
+# they are loaded when a local copy is not available
+UI_ASSETS = {
+    'redoc': {
+        'redoc.standalone.js':
+            'https://cdn.jsdelivr.net/npm/redoc@2/bundles/redoc.standalone.js',
+    },
+    'swagger_ui': {
+        'swagger-ui.css': 'https://unpkg.com/swagger-ui-dist/swagger-ui.css',
+        'swagger-ui-bundle.js':
+            'https://unpkg.com/swagger-ui-dist/swagger-ui-bundle.js',
+        'swagger-ui-standalone-preset.js':
+            'https://unpkg.com/swagger-ui-dist/'
+            'swagger-ui-standalone-preset.js',
+    },
+    'rapidoc': {
+        'rapidoc-min.js': 'https://unpkg.com/rapidoc/dist/rapidoc-min.js',
+    },
+    'elements': {
+        'web-components.min.js':
+            'https://unpkg.com/@stoplight/elements/web-components.min.js',
+        'styles.min.css':
+            'https://unpkg.com/@stoplight/elements/styles.min.css',
+    },
+}
+
+# precompressed variants of an asset are stored next to it, with these
+# extensions added to its filename
+ASSET_ENCODINGS = {'br': '.br', 'gzip': '.gz'}
+
+
+def hashed_filename(filename, data):
+    """Return the filename with a hash of the given contents inserted before
+    its extension, so that a new URL is used when the contents change."""
+    root, ext = os.path.splitext(filename)
+    return f'{root}.{sha256(data).hexdigest()[:12]}{ext}'
+
+
+def read_asset(folder, filename):
+    """Read an asset file and any precompressed variants of it.
+
+    The return value is a tuple with the contents of the file, a dictionary
+    with the precompressed variants of the file, indexed by encoding, and the
+    content type of the file. ``None`` is returned if the file does not
+    exist.
+    """
+    path = os.path.join(folder, filename)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'rb') as f:
+        data = f.read()
+    variants = {}
+    for encoding, ext in ASSET_ENCODINGS.items():
+        # variants older than the file are ignored, as they may be stale
+        if os.path.isfile(path + ext) and \
+                os.path.getmtime(path + ext) >= os.path.getmtime(path):
+            with open(path + ext, 'rb') as f:
+                variants[encoding] = f.read()
+    content_type = mimetypes.guess_type(filename)[0] or \
+        'application/octet-stream'
+    if content_type.startswith('text/'):
+        content_type += '; charset=utf-8'
+    return data, variants, content_type
@@ -0,0 +1,75 @@
+import gzip
+from json import dumps
+import os
+from urllib.request import urlopen
+
+import click
+from flask import current_app
+from flask.cli import AppGroup
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+from apifairy.assets import ASSET_ENCODINGS, UI_ASSETS
+
+apifairy_cli = AppGroup('apifairy', help='APIFairy commands.')
+
+
+@apifairy_cli.command('export')
+@click.argument('output', type=click.File('w'), default='-')
+@click.option('--server-url', default=None,
+              help='URL to include in the servers section of the spec.')
+@click.option('--format', 'format_', type=click.Choice(['json', 'yaml']),
+              default=None, help='Output format. If not given, it is '
+              'determined from the extension of the output file.')
+@click.option('--indent', type=int, default=None,
+              help='Indentation level for JSON output.')
+def export(output, server_url, format_, indent):
+    """Write the OpenAPI specification to a file."""
+    apifairy = current_app.extensions['apifairy']
+    apispec = apifairy._build_apispec(server_url=server_url)
+    if format_ is None:
+        format_ = 'yaml' if output.name.endswith(('.yaml', '.yml')) \
+            else 'json'
+    if format_ == 'yaml':
+        try:
+            import yaml
+        except ImportError:  # pragma: no cover
+            raise click.ClickException(
+                'The PyYAML package is required for YAML output.')
+        output.write(yaml.safe_dump(apispec, sort_keys=False))
+    else:
+        output.write(dumps(apispec, indent=indent))
+        output.write('\n')
+
+
+@apifairy_cli.command('download-ui')
+@click.argument('directory', default=None, required=False)
+@click.option('--ui', 'uis', type=click.Choice(list(UI_ASSETS)),
+              multiple=True, help='Documentation UI to download. Can be '
+              'given multiple times. If not given, the configured UI is '
+              'downloaded.')
+def download_ui(directory, uis):
+    """Download the documentation UI files to serve them locally."""
+    apifairy = current_app.extensions['apifairy']
+    directory = directory or apifairy.ui_assets
+    if not directory:
+        raise click.ClickException(
+            'A directory must be given when the APIFAIRY_UI_ASSETS option is '
+            'not set.')
+    os.makedirs(directory, exist_ok=True)
+    for ui in uis or [apifairy.ui]:
+        for filename, url in UI_ASSETS[ui].items():
+            click.echo(f'Downloading {url}')
+            with urlopen(url) as response:
+                data = response.read()
+            variants = {'gzip': gzip.compress(data, compresslevel=9, mtime=0)}
+            if brotli is not None:  # pragma: no cover
+                variants['br'] = brotli.compress(data)
+            path = os.path.join(directory, filename)
+            with open(path, 'wb') as f:
+                f.write(data)
+            for encoding, variant in variants.items():
+                with open(path + ASSET_ENCODINGS[encoding], 'wb') as f:
+                    f.write(variant)
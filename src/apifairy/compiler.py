@@ -0,0 +1,170 @@
+from marshmallow import fields, missing, ValidationError
+from marshmallow.decorators import PRE_DUMP, POST_DUMP, PRE_LOAD, \
+    POST_LOAD, VALIDATES, VALIDATES_SCHEMA
+from marshmallow.schema import Schema
+from marshmallow.utils import get_value
+
+
+def _str(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8')
+    return str(value)
+
+
+def _has_hooks(schema, *tags):
+    # marshmallow 4 indexes hooks by tag, while marshmallow 3 indexes them by
+    # tag and by whether they process whole collections
+    hooks = schema._hooks
+    return any(hooks.get(tag) or hooks.get((tag, False)) or
+               hooks.get((tag, True)) for tag in tags)
+
+
+def _compile_field(field, compiling):
+    # return a function that formats a value in the same way as the field's
+    # _serialize() method, or None if the field has no fast path
+    field_class = type(field)
+    if field_class is fields.Raw:
+        return lambda value: value
+    elif field_class is fields.String:
+        return lambda value: None if value is None else _str(value)
+    elif field_class in (fields.Integer, fields.Float) and \
+            not field.as_string:
+        num_type = field.num_type
+        return lambda value: None if value is None else num_type(value)
+    elif field_class is fields.Nested:
+        schema = field.schema
+        dump = _compile_schema(schema, compiling)
+        if dump is not None:
+            many = schema.many or bool(field.many)
+            return lambda value: None if value is None else dump(value, many)
+    elif field_class is fields.List:
+        inner = _compile_field(field.inner, compiling)
+        if inner is not None:
+            return lambda value: None if value is None else [
+                inner(item) for item in value]
+    return None
+
+
+def _compile_schema(schema, compiling):
+    schema_class = type(schema)
+    if schema_class in compiling:
+        # recursive schemas are handled by marshmallow
+        return None
+    if _has_hooks(schema, PRE_DUMP, POST_DUMP) or \
+            schema_class.get_attribute is not Schema.get_attribute:
+        return None
+    compiling = compiling | {schema_class}
+
+    plan = []
+    for attr_name, field in schema.dump_fields.items():
+        key = field.data_key if field.data_key is not None else attr_name
+        format_value = None
+        if field._CHECK_ATTRIBUTE and \
+                type(field).get_value is fields.Field.get_value:
+            format_value = _compile_field(field, compiling)
+        source = field.attribute or attr_name
+        plan.append((attr_name, key, source, '.' not in source,
+                     field.dump_default, format_value, field))
+    dict_class = schema.dict_class
+    accessor = schema.get_attribute
+
+    def dump_one(obj):
+        ret = dict_class()
+        for attr_name, key, source, plain_source, default, format_value, \
+                field in plan:
+            if format_value is None:
+                value = field.serialize(attr_name, obj, accessor=accessor)
+                if value is missing:
+                    continue
+                ret[key] = value
+                continue
+            if plain_source and type(obj) is dict and source in obj:
+                value = obj[source]
+            else:
+                value = get_value(obj, source)
+            if value is missing:
+                value = default() if callable(default) else default
+                if value is missing:
+                    continue
+            ret[key] = format_value(value)
+        return ret
+
+    def dump(obj, many=None):
+        if many is None:
+            many = schema.many
+        if many and obj is not None:
+            return [dump_one(item) for item in obj]
+        return dump_one(obj)
+
+    return dump
+
+
+def compile_schema(schema):
+    """Return a function that serializes objects in the same way as the
+    ``dump()`` method of the given schema, but faster.
+
+    Plain fields, nested schemas and lists are serialized directly, and any
+    other field types are serialized by the field itself. ``None`` is returned
+    for schemas that use ``pre_dump`` or ``post_dump`` hooks, or a custom
+    ``get_attribute()`` method, since these need to go through marshmallow.
+    """
+    return _compile_schema(schema, frozenset())
+
+
+_LOADER_FIELDS = (fields.String, fields.Integer, fields.Float, fields.Boolean,
+                  fields.Enum)
+
+
+def compile_loader(schema):
+    """Return a function that loads arguments from a ``MultiDict`` in the same
+    way as webargs and the ``load()`` method of the given schema, but faster.
+
+    Only flat schemas with string, number, boolean and enum fields, or lists
+    of them, can be compiled. Unknown arguments are ignored, and validation
+    errors are raised with the same messages as marshmallow. ``None`` is
+    returned for schemas that cannot be compiled, including schemas that use
+    load hooks or validators, since these need to go through marshmallow.
+    """
+    if schema.many or schema.partial or _has_hooks(
+            schema, PRE_LOAD, POST_LOAD, VALIDATES, VALIDATES_SCHEMA):
+        return None
+    plan = []
+    for attr_name, field in schema.load_fields.items():
+        multiple = type(field) is fields.List
+        field_class = type(field.inner) if multiple else type(field)
+        if field_class not in _LOADER_FIELDS:
+            return None
+        key = field.data_key if field.data_key is not None else attr_name
+        target = field.attribute or attr_name
+        if '.' in target:
+            return None
+        # present values of fields without validators only need conversion
+        convert = None if field.validators else field._deserialize
+        plan.append((key, target, multiple, field.deserialize, convert))
+    dict_class = schema.dict_class
+
+    def load(args):
+        ret = dict_class()
+        errors = {}
+        for key, target, multiple, deserialize, convert in plan:
+            if key not in args:
+                value = missing
+            elif multiple:
+                value = args.getlist(key)
+            else:
+                value = args[key]
+            try:
+                if convert is None or value is missing or value is None:
+                    value = deserialize(value, key, args)
+                else:
+                    value = convert(value, key, args)
+            except ValidationError as error:
+                errors[key] = error.messages
+                continue
+            if value is not missing:
+                ret[target] = value
+        if errors:
+            raise ValidationError(errors, data=args, valid_data=ret)
+        return ret
+
+    return load
@@ -1,15 +1,29 @@
-from json import dumps
+from collections import OrderedDict
+from copy import copy, deepcopy
+import gzip
+from hashlib import sha256
+from json import dumps, loads
+import os
 import re
 import sys
+import threading
 try:
     from typing import _AnnotatedAlias
 except ImportError:  # pragma: no cover
     _AnnotatedAlias = None
 
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
 from apispec import APISpec
 from apispec.ext.marshmallow import MarshmallowPlugin
-from flask import current_app, Blueprint, render_template, request
+from apispec.ext.marshmallow.common import make_schema_key, \
+    resolve_schema_instance
+from flask import abort, current_app, Blueprint, render_template, request, \
+    has_request_context, url_for
 from flask_marshmallow import fields
+from marshmallow import Schema
 try:
     from flask_marshmallow import sqla
 except ImportError:
@@ -22,23 +36,89 @@ except ImportError:  # pragma: no cover
 from packaging.version import Version
 from werkzeug.http import HTTP_STATUS_CODES
 
+from apifairy.assets import UI_ASSETS, hashed_filename, read_asset
+from apifairy.cli import apifairy_cli
 from apifairy.decorators import _webhooks
 from apifairy.exceptions import ValidationError
 from apifairy import fields as apifairy_fields
 
+_OPERATION_METHODS = frozenset(['GET', 'POST', 'PUT', 'PATCH', 'DELETE'])
+_PATH_ARGUMENT_RE = re.compile(r'<(([^<:]+:)?([^>]+))>')
+_PATH_CONVERTER_RE = re.compile(r'<([^<:]+:)?')
+_PATH_ITEM_OPERATIONS = frozenset(['get', 'put', 'post', 'delete', 'options',
+                                   'head', 'patch', 'trace'])
+
+
+class _Payload:
+    """A response body that is encoded and compressed only once.
+
+    Compressed variants that were generated in advance can be given in
+    ``variants``, indexed by encoding.
+    """
+    def __init__(self, data, content_type, compress=True, variants=None):
+        variants = variants or {}
+        self.content_type = content_type
+        self.encodings = ['identity']
+        if compress or 'gzip' in variants:
+            self.encodings.insert(0, 'gzip')
+        if (compress and brotli is not None) or 'br' in variants:
+            self.encodings.insert(0, 'br')
+        self.variants = {'identity': (data, sha256(data).hexdigest())}
+        for encoding, variant in variants.items():
+            self.variants[encoding] = (variant, sha256(variant).hexdigest())
+
+    def get_variant(self, encoding):
+        if encoding not in self.variants:
+            data = self.variants['identity'][0]
+            if encoding == 'br':  # pragma: no cover
+                data = brotli.compress(data)
+            else:
+                data = gzip.compress(data, mtime=0)
+            self.variants[encoding] = (data, sha256(data).hexdigest())
+        return self.variants[encoding]
+
+    def make_response(self, cache_control=None):
+        encoding = request.accept_encodings.best_match(
+            self.encodings, default='identity')
+        data, etag = self.get_variant(encoding)
+        rv = current_app.response_class(data, content_type=self.content_type)
+        if encoding != 'identity':
+            rv.content_encoding = encoding
+        if len(self.encodings) > 1:
+            rv.vary.add('Accept-Encoding')
+        rv.set_etag(etag)
+        if cache_control:
+            rv.headers['Cache-Control'] = cache_control
+        return rv.make_conditional(request)
+
 
 class APIFairy:
     def __init__(self, app=None):
         self.title = None
         self.version = None
         self.apispec_path = None
+        self.apispec_file = None
         self.ui = None
         self.ui_path = None
+        self.ui_assets = None
         self.tags = None
+        self.json_encoder = None
 
         self.apispec_callback = None
         self.error_handler_callback = self.default_error_handler
+        self.metrics_callback = None
         self._apispec = None
+        self._apispec_payload = None
+        self._apispec_body = None
+        self._apispec_payloads = OrderedDict()
+        self._apispec_lock = threading.Lock()
+        self._spec_state = None
+        self._docs_payloads = OrderedDict()
+        self._split_apispec = None
+        self._split_tags = None
+        self._split_payloads = OrderedDict()
+        self._ui_asset_urls = None
+        self._ui_asset_payloads = None
         if app is not None:  # pragma: no cover
             self.init_app(app)
 
@@ -50,31 +130,84 @@ class APIFairy:
         self.apispec_version = app.config.get('APIFAIRY_APISPEC_VERSION', None)
         self.apispec_decorators = app.config.get(
             'APIFAIRY_APISPEC_DECORATORS', [])
+        self.apispec_cache_control = app.config.get(
+            'APIFAIRY_APISPEC_CACHE_CONTROL', None)
+        self.apispec_compression = app.config.get(
+            'APIFAIRY_APISPEC_COMPRESSION', True)
+        self.apispec_cache_size = app.config.get(
+            'APIFAIRY_APISPEC_CACHE_SIZE', 16)
+        self.apispec_file = app.config.get('APIFAIRY_APISPEC_FILE')
+        self.apispec_split = app.config.get('APIFAIRY_APISPEC_SPLIT', False)
+        self.prune_components = app.config.get(
+            'APIFAIRY_PRUNE_COMPONENTS', False)
+        if self.apispec_file:
+            self.apispec_file = os.path.join(app.root_path, self.apispec_file)
         self.ui = app.config.get('APIFAIRY_UI', 'redoc')
         self.ui_path = app.config.get('APIFAIRY_UI_PATH', '/docs')
         self.ui_decorators = app.config.get('APIFAIRY_UI_DECORATORS', [])
+        self.ui_assets = app.config.get('APIFAIRY_UI_ASSETS')
+        if self.ui_assets:
+            self.ui_assets = os.path.join(app.root_path, self.ui_assets)
         self.tags = app.config.get('APIFAIRY_TAGS')
+        self.json_encoder = app.config.get('APIFAIRY_JSON_ENCODER')
+        app.extensions['apifairy'] = self
+        app.cli.add_command(apifairy_cli)
 
         bp = Blueprint('apifairy', __name__, template_folder='templates')
 
         if self.apispec_path:
             def json():
-                return dumps(self.apispec), 200, \
-                    {'Content-Type': 'application/json'}
+                return self._get_apispec_payload().make_response(
+                    self.apispec_cache_control)
 
             for decorator in self.apispec_decorators:
                 json = decorator(json)
             bp.add_url_rule(self.apispec_path, 'json', json)
 
+            if self.apispec_split:
+                def json_index():
+                    return self._get_split_payload(None).make_response(
+                        self.apispec_cache_control)
+
+                def json_tag(tag):
+                    return self._get_split_payload(tag).make_response(
+                        self.apispec_cache_control)
+
+                for decorator in self.apispec_decorators:
+                    json_index = decorator(json_index)
+                    json_tag = decorator(json_tag)
+                base_path = self.apispec_path[:-5] \
+                    if self.apispec_path.endswith('.json') \
+                    else self.apispec_path
+                bp.add_url_rule(base_path + '/index.json', 'json_index',
+                                json_index)
+                bp.add_url_rule(base_path + '/<tag>.json', 'json_tag',
+                                json_tag)
+
         if self.ui_path:
             def docs():
-                return render_template(f'apifairy/{self.ui}.html',
-                                       title=self.title, version=self.version)
+                return self._get_docs_payload().make_response()
 
             for decorator in self.ui_decorators:
                 docs = decorator(docs)
             bp.add_url_rule(self.ui_path, 'docs', docs)
 
+            if self.ui_assets:
+                def ui_asset(filename):
+                    self._load_ui_assets()
+                    payload = self._ui_asset_payloads.get(filename)
+                    if payload is None:
+                        abort(404)
+                    # asset URLs change when their contents change, so they
+                    # can be cached indefinitely
+                    return payload.make_response(
+                        'public, max-age=31536000, immutable')
+
+                for decorator in self.ui_decorators:
+                    ui_asset = decorator(ui_asset)
+                bp.add_url_rule(self.ui_path.rstrip('/') +
+                                '/assets/<filename>', 'ui_asset', ui_asset)
+
         if self.apispec_path or self.ui_path:  # pragma: no cover
             app.register_blueprint(bp)
 
@@ -91,18 +224,248 @@ class APIFairy:
         self.error_handler_callback = f
         return f
 
+    def metrics_handler(self, f):
+        self.metrics_callback = f
+        return f
+
     def default_error_handler(self, status_code, messages):
         return {'messages': messages}, status_code
 
     @property
     def apispec(self):
         if self._apispec is None:
-            self._apispec = self._generate_apispec()
-            if self.apispec_callback:
-                self._apispec = self.apispec_callback(self._apispec)
+            if self.apispec_file:
+                self._load_apispec()
+            else:
+                self._build_apispec()
+        elif self._spec_state is not None and self._spec_state.is_stale():
+            # routes were added after the spec was generated
+            state = self._spec_state
+            with self._apispec_lock, state.app.app_context():
+                if state.is_stale():  # pragma: no branch
+                    self._build_apispec(
+                        server_url=None if state.auto_server_url
+                        else state.server_url, update=True)
         return self._apispec
 
-    def _generate_apispec(self):
+    def build_spec(self, app=None, server_url=None):
+        """Generate the OpenAPI definition ahead of time.
+
+        This method does not need a request context, so it can be called
+        during the application's startup, for example in the master process of
+        a pre-fork web server. The generated definition is also serialized and
+        compressed, so that forked workers can serve it without doing any
+        work.
+
+        :param app: The Flask application. If not given, the application that
+                    is current is used.
+        :param server_url: The URL to include in the ``servers`` section of
+                           the definition. If not given, the relative URL
+                           ``/`` is used, which the JSON endpoint replaces
+                           with the root URL of each request only when the
+                           application is mounted under a URL prefix.
+        """
+        app = app or current_app._get_current_object()
+        with app.app_context():
+            self._build_apispec(server_url=server_url)
+        payload = self._get_apispec_payload()
+        for encoding in payload.encodings:
+            payload.get_variant(encoding)
+        if self._spec_state.auto_server_url:
+            with self._apispec_lock:
+                self._get_apispec_body(self._apispec)
+        return self._apispec
+
+    def _build_apispec(self, server_url=None, update=False):
+        state = self._spec_state
+        if update and state.has_webhooks == bool(_webhooks):
+            # only generate the parts of the spec for the new routes
+            self._update_spec_state(state)
+            apispec = self._render_spec(state)
+        else:
+            apispec = self._generate_apispec(server_url=server_url)
+        if self.apispec_callback:
+            apispec = self.apispec_callback(apispec)
+        if self.prune_components:
+            apispec = _prune_components(apispec)
+        self._apispec = apispec
+        self._apispec_payload = None
+        return apispec
+
+    def _load_apispec(self):
+        # the spec was generated in advance with the "flask apifairy export"
+        # command, so the file is served as is
+        with open(self.apispec_file, 'rb') as f:
+            data = f.read()
+        self._apispec = loads(data)
+        self._apispec_payload = _Payload(data, 'application/json',
+                                         compress=self.apispec_compression)
+
+    def _get_apispec_payload(self):
+        # the serialized spec is cached along with its ETag and compressed
+        # variants, so that the JSON endpoint does not have to encode the spec
+        # on every request
+        apispec = self.apispec
+        if self._apispec_payload is None:
+            self._apispec_payload = _Payload(
+                dumps(apispec).encode(), 'application/json',
+                compress=self.apispec_compression)
+            self._apispec_body = None
+            self._apispec_payloads.clear()
+        url = self._get_request_server_url(apispec)
+        if url is None:
+            return self._apispec_payload
+
+        # the server URL was taken from the request, so each host that the
+        # application is accessed from gets its own copy of the spec
+        with self._apispec_lock:
+            payload = self._apispec_payloads.get(url)
+            if payload is not None:
+                self._apispec_payloads.move_to_end(url)
+                return payload
+            payload = _Payload(
+                b'{"servers": ' + dumps([{'url': url}]).encode() + b', ' +
+                self._get_apispec_body(apispec)[1:], 'application/json',
+                compress=self.apispec_compression)
+            self._apispec_payloads[url] = payload
+            while len(self._apispec_payloads) > self.apispec_cache_size:
+                self._apispec_payloads.popitem(last=False)
+        return payload
+
+    def _get_apispec_body(self, apispec):
+        # the part of the spec that is the same for all hosts is serialized
+        # only once
+        if self._apispec_body is None:
+            self._apispec_body = dumps({
+                key: value for key, value in apispec.items()
+                if key != 'servers'}).encode()
+        return self._apispec_body
+
+    def _get_request_server_url(self, apispec):
+        # return the root URL of the request when it needs to replace the
+        # server URL of the spec, or None if the spec can be used as is
+        state = self._spec_state
+        if state is None or not state.auto_server_url or \
+                not has_request_context() or \
+                request.url_root == state.server_url or \
+                apispec.get('servers') != [{'url': state.server_url}]:
+            return None
+        if state.server_url == '/' and not request.script_root:
+            # the spec was generated outside of a request, and its relative
+            # server URL already points to the root of the application
+            return None
+        return request.url_root
+
+    def _get_split_tags(self):
+        # return the tags of the split spec, resetting the cached split specs
+        # and documentation pages when the spec changes
+        apispec = self.apispec
+        with self._apispec_lock:
+            if self._split_apispec is not apispec:
+                self._split_apispec = apispec
+                self._split_tags = _spec_tags(apispec)
+                self._split_payloads.clear()
+                self._docs_payloads.clear()
+            return apispec, self._split_tags
+
+    def _get_split_payload(self, tag):
+        # the index and the spec of each tag are generated on first use and
+        # cached independently of each other
+        apispec, tags = self._get_split_tags()
+        if tag is not None and tag not in tags:
+            abort(404)
+        url = self._get_request_server_url(apispec)
+        key = (tag, url)
+        with self._apispec_lock:
+            payload = self._split_payloads.get(key)
+            if payload is not None:
+                self._split_payloads.move_to_end(key)
+                return payload
+        if tag is None:
+            data = {
+                'info': apispec.get('info', {}),
+                'tags': [{'name': name, 'url': url_for('apifairy.json_tag',
+                                                       tag=name)}
+                         for name in tags],
+            }
+        else:
+            data = _tag_apispec(apispec, tag)
+            if url is not None:
+                data['servers'] = [{'url': url}]
+        payload = _Payload(dumps(data).encode(), 'application/json',
+                           compress=self.apispec_compression)
+        with self._apispec_lock:
+            self._split_payloads[key] = payload
+            while len(self._split_payloads) > \
+                    self.apispec_cache_size * (len(tags) + 1):
+                self._split_payloads.popitem(last=False)
+        return payload
+
+    def _get_docs_payload(self):
+        # the documentation page only changes with the root URL of the
+        # application and the selected tag, so it is rendered once for each
+        # of them, unless templates are being reloaded
+        tags = []
+        tag = None
+        if self.apispec_split:
+            _, tags = self._get_split_tags()
+            tag = request.args.get('tag') or None
+            if tag is not None and tag not in tags:
+                abort(404)
+        key = (request.script_root, tag)
+        payload = self._docs_payloads.get(key)
+        if payload is not None:
+            return payload
+        spec_url = url_for('apifairy.json_tag', tag=tag) if tag \
+            else url_for('apifairy.json')
+        payload = _Payload(
+            render_template(f'apifairy/{self.ui}.html', title=self.title,
+                            version=self.version, spec_url=spec_url,
+                            tags=tags, tag=tag,
+                            asset_url=self._get_ui_asset_url,
+                            local_assets=bool(self.ui_assets)).encode(),
+            'text/html; charset=utf-8', compress=self.apispec_compression)
+        if not current_app.jinja_env.auto_reload:
+            with self._apispec_lock:
+                self._docs_payloads[key] = payload
+                while len(self._docs_payloads) > \
+                        self.apispec_cache_size * (len(tags) + 1):
+                    self._docs_payloads.popitem(last=False)
+        return payload
+
+    def _load_ui_assets(self):
+        # the local copies of the documentation assets are read once, and
+        # then served from memory under a filename that includes their hash
+        if self._ui_asset_payloads is not None:
+            return
+        urls = {}
+        payloads = {}
+        for filename in UI_ASSETS.get(self.ui, {}):
+            asset = read_asset(self.ui_assets, filename)
+            if asset is None:
+                continue
+            data, variants, content_type = asset
+            urls[filename] = hashed_filename(filename, data)
+            payloads[urls[filename]] = _Payload(data, content_type,
+                                                variants=variants)
+        self._ui_asset_urls = urls
+        self._ui_asset_payloads = payloads
+
+    def _get_ui_asset_url(self, filename):
+        # assets that are not available locally are loaded from the CDN
+        if self.ui_assets:
+            self._load_ui_assets()
+            if filename in self._ui_asset_urls:
+                return url_for('apifairy.ui_asset',
+                               filename=self._ui_asset_urls[filename])
+        return UI_ASSETS[self.ui][filename]
+
+    def _generate_apispec(self, server_url=None):
+        self._spec_state = self._create_spec_state(server_url)
+        self._update_spec_state(self._spec_state)
+        return self._render_spec(self._spec_state)
+
+    def _create_spec_state(self, server_url=None):
         def resolver(schema):
             name = schema.__class__.__name__
             if name.endswith("Schema"):
@@ -124,30 +487,17 @@ class APIFairy:
             module_name = module_name.rsplit('.', 1)[0]
 
         # servers
-        servers = [{'url': request.url_root}]
+        auto_server_url = server_url is None
+        if auto_server_url:
+            server_url = request.url_root if has_request_context() else '/'
+        servers = [{'url': server_url}]
+
+        # tags given in the configuration
+        tag_list = []
+        if self.tags is not None:
+            tags = self._generate_tags(self.tags)
+            tag_list = [tags[name] for name in self.tags]
 
-        # tags
-        tag_names = self.tags
-        if tag_names is None:  # pragma: no branch
-            # auto-generate tags from blueprints
-            tag_names = []
-            for rule in current_app.url_map.iter_rules():
-                view_func = current_app.view_functions[rule.endpoint]
-                if hasattr(view_func, '_spec'):
-                    if '.' in rule.endpoint:
-                        blueprint = rule.endpoint.rsplit('.', 1)[0]
-                        if blueprint not in tag_names:  # pragma: no branch
-                            tag_names.append(blueprint)
-        tags = {}
-        for name, blueprint in current_app.blueprints.items():
-            if name not in tag_names:
-                continue
-            module = sys.modules[blueprint.import_name]
-            tag = {'name': name.title()}
-            if module.__doc__:  # pragma: no cover
-                tag['description'] = module.__doc__.strip()
-            tags[name] = tag
-        tag_list = [tags[name] for name in tag_names]
         ma_plugin = MarshmallowPlugin(schema_name_resolver=resolver)
         apispec_version = self.apispec_version
         if apispec_version is None:
@@ -180,35 +530,97 @@ class APIFairy:
         ma_plugin.converter.field_mapping[apifairy_fields.FileField] = \
             ('string', 'binary')
 
+        return _SpecState(current_app._get_current_object(), spec, ma_plugin,
+                          server_url, auto_server_url, tag_list,
+                          bool(_webhooks))
+
+    def _generate_tags(self, tag_names):
+        tags = {}
+        blueprints = current_app.blueprints
+        for name in tag_names:
+            blueprint = blueprints.get(name)
+            if blueprint is None:
+                continue
+            module = sys.modules[blueprint.import_name]
+            tag = {'name': name.title()}
+            if module.__doc__:  # pragma: no cover
+                tag['description'] = module.__doc__.strip()
+            tags[name] = tag
+        return tags
+
+    @staticmethod
+    def _security_scheme_name(auth, used_names):
+        if isinstance(auth, HTTPBasicAuth):
+            name = 'basic_auth'
+        elif isinstance(auth, HTTPTokenAuth):
+            if auth.scheme == 'Bearer' and auth.header is None:
+                name = 'token_auth'
+            else:
+                name = 'api_key'
+        else:  # pragma: no cover
+            raise RuntimeError('Unknown authentication scheme')
+        if name in used_names:
+            apispec_version = 2
+            new_name = f'{name}_{apispec_version}'
+            while new_name in used_names:
+                apispec_version += 1
+                new_name = f'{name}_{apispec_version}'
+            name = new_name
+        used_names.add(name)
+        return name
+
+    def _update_spec_state(self, state):
+        # only the rules and webhooks that were added since the last update
+        # are processed, everything else is already in the spec
+        spec = state.spec
+        view_functions = current_app.view_functions
+        new_rules = []
+        new_tag_names = {}  # used as an ordered set
+        new_auths = {}  # auth object -> security scheme name
+        for index, rule in enumerate(current_app.url_map.iter_rules()):
+            # rules are kept alive by the URL map, so their ids are unique
+            if id(rule) in state.rules:
+                continue
+            state.rules.add(id(rule))
+            endpoint = rule.endpoint
+            state.endpoints.setdefault(endpoint, [])
+            new_rules.append((rule, index))
+            spec_info = getattr(view_functions[endpoint], '_spec', None)
+            if spec_info is None:
+                continue
+
+            # blueprints without a tag
+            if '.' in endpoint:
+                blueprint = endpoint.rsplit('.', 1)[0]
+                if blueprint not in state.tag_names:
+                    new_tag_names[blueprint] = None
+
+            # authentication objects without a security scheme
+            auth = spec_info.get('auth')
+            if auth is not None and auth not in state.security and \
+                    auth not in new_auths:
+                new_auths[auth] = self._security_scheme_name(
+                    auth, state.security_names)
+        state.view_count = len(view_functions)
+        state.rule_count = len(current_app.url_map._rules)
+        new_webhooks = [rule for endpoint, rule in _webhooks.items()
+                        if endpoint not in state.webhooks]
+        for rule in new_webhooks:
+            state.webhooks[rule.endpoint] = []
+        state.webhook_count = len(_webhooks)
+
+        # tags
+        if self.tags is None:  # pragma: no branch
+            # auto-generate tags from blueprints
+            tags = self._generate_tags(new_tag_names)
+            for name in new_tag_names:
+                state.tag_list.append(tags[name])
+            state.tag_names.update(new_tag_names)
+
         # security schemes
-        auth_schemes = []
-        auth_names = []
-        for rule in current_app.url_map.iter_rules():
-            view_func = current_app.view_functions[rule.endpoint]
-            if hasattr(view_func, '_spec'):
-                auth = view_func._spec.get('auth')
-                if auth is not None and auth not in auth_schemes:
-                    auth_schemes.append(auth)
-                    if isinstance(auth, HTTPBasicAuth):
-                        name = 'basic_auth'
-                    elif isinstance(auth, HTTPTokenAuth):
-                        if auth.scheme == 'Bearer' and auth.header is None:
-                            name = 'token_auth'
-                        else:
-                            name = 'api_key'
-                    else:  # pragma: no cover
-                        raise RuntimeError('Unknown authentication scheme')
-                    if name in auth_names:
-                        apispec_version = 2
-                        new_name = f'{name}_{apispec_version}'
-                        while new_name in auth_names:  # pragma: no cover
-                            apispec_version += 1
-                            new_name = f'{name}_{apispec_version}'
-                        name = new_name
-                    auth_names.append(name)
-        security = {}
+        security = state.security
         security_schemes = {}
-        for name, auth in zip(auth_names, auth_schemes):
+        for auth, name in new_auths.items():
             security[auth] = name
             if isinstance(auth, HTTPTokenAuth):
                 if auth.scheme == 'Bearer' and auth.header is None:
@@ -235,189 +647,404 @@ class APIFairy:
                     spec.components.security_scheme(name, scheme)
 
         # paths
-        paths = {}
-        rules = list(current_app.url_map.iter_rules())
-        rules = sorted(rules, key=lambda rule: len(rule.rule))
-        rules += _webhooks.values()
-        for rule in rules:
-            operations = {}
+        rules = sorted(new_rules, key=lambda rule: len(rule[0].rule))
+        rules += [(rule, None) for rule in new_webhooks]
+        paths = {}  # path -> rules that add operations to it
+        for rule, index in rules:
             is_endpoint = True  # False for webhooks
-            view_func = current_app.view_functions.get(rule.endpoint)
+            view_func = view_functions.get(rule.endpoint)
             if view_func is None:
                 is_endpoint = False
                 view_func = rule.view_func
             if not hasattr(view_func, '_spec'):
                 continue
-            if '.' in rule.endpoint:
-                tag, endpoint = rule.endpoint.rsplit('.', 1)
-                tag = tag.title()
+            if is_endpoint:
+                path = _PATH_CONVERTER_RE.sub('{', rule.rule).replace('>', '}')
+                key = (0, len(rule.rule), index)
+                state.endpoints[rule.endpoint].append(path)
             else:
-                tag = None
-                endpoint = rule.endpoint
-            methods = [method for method in rule.methods
-                       if method in ['GET', 'POST', 'PUT', 'PATCH', 'DELETE']]
-            for method in methods:
-                operation_id = rule.endpoint.replace('.', '_')
-                if len(methods) > 1:
-                    operation_id = method.lower() + '_' + operation_id
-                operation = {
-                    'operationId': operation_id,
-                    'parameters': [
-                        {'in': location, 'schema': schema}
-                        for schema, location in view_func._spec.get('args', [])
-                        if location != 'body'
-                    ],
-                }
-                if tag:
-                    operation['tags'] = [tag]
-                docs = [line.strip() for line in (
-                    view_func.__doc__ or '').strip().split('\n')]
-                if docs[0]:
-                    operation['summary'] = docs[0]
-                if len(docs) > 1:
-                    operation['description'] = '\n'.join(docs[1:]).strip()
-                if view_func._spec.get('response'):
-                    code = str(view_func._spec['status_code'])
-                    operation['responses'] = {
-                        code: {
-                            'content': {
-                                'application/json': {
-                                    'schema': view_func._spec.get('response')
-                                }
+                # apispec does not support webhooks, so here they are added as
+                # paths, and later they are moved to their own section after
+                # the spec is generated
+                path = 'webhook:' + rule.endpoint.rsplit('.', 1)[-1]
+                key = (1, len(state.webhooks_order), 0)
+                state.webhooks_order.append(path)
+                state.webhooks[rule.endpoint].append(path)
+            paths.setdefault(path, []).append((rule, view_func, is_endpoint))
+            if path not in state.path_keys or key < state.path_keys[path]:
+                state.path_keys[path] = key
+
+        for path, path_rules in paths.items():
+            spec.path(path=path, operations=self._path_operations(
+                path_rules, state.security, state.schemas))
+
+    def _path_operations(self, path_rules, security, schemas):
+        operations = {}
+        for rule, view_func, is_endpoint in path_rules:
+            operations.update(self._rule_operations(
+                rule, view_func, is_endpoint, security, schemas))
+
+        # sort by method before adding them to the spec
+        sorted_operations = {}
+        for method in ['get', 'post', 'put', 'patch', 'delete']:
+            if method in operations:
+                sorted_operations[method] = operations[method]
+
+        # schemas are converted here instead of by apispec, so that each
+        # distinct schema is converted only once, and apispec does not need
+        # to make a deep copy of the schema objects in each operation
+        for operation in sorted_operations.values():
+            schemas.resolve_operation(operation)
+        return sorted_operations
+
+    def _rule_operations(self, rule, view_func, is_endpoint, security,
+                         schemas):
+        operations = {}
+        if '.' in rule.endpoint:
+            tag = rule.endpoint.rsplit('.', 1)[0].title()
+        else:
+            tag = None
+        methods = [method for method in rule.methods
+                   if method in _OPERATION_METHODS]
+        for method in methods:
+            operation_id = rule.endpoint.replace('.', '_')
+            if len(methods) > 1:
+                operation_id = method.lower() + '_' + operation_id
+            operation = {
+                'operationId': operation_id,
+                'parameters': [
+                    {'in': location, 'schema': schema}
+                    for schema, location in view_func._spec.get('args', [])
+                    if location != 'body'
+                ],
+            }
+            if tag:
+                operation['tags'] = [tag]
+            docs = [line.strip() for line in (
+                view_func.__doc__ or '').strip().split('\n')]
+            if docs[0]:
+                operation['summary'] = docs[0]
+            if len(docs) > 1:
+                operation['description'] = '\n'.join(docs[1:]).strip()
+            if view_func._spec.get('response'):
+                code = str(view_func._spec['status_code'])
+                operation['responses'] = {
+                    code: {
+                        'content': {
+                            'application/json': {
+                                'schema': view_func._spec.get('response')
                             }
                         }
                     }
-                    operation['responses'][code]['description'] = \
-                        view_func._spec['description'] or HTTP_STATUS_CODES[
-                            int(code)]
-                    if view_func._spec.get('response_headers'):
-                        schema = view_func._spec.get('response_headers')
-                        if isinstance(schema, type):  # pragma: no branch
-                            schema = schema()
-                        headers = ma_plugin.converter.schema2parameters(
-                            schema, location='headers')
-                        operation['responses'][code]['headers'] = {
-                            header['name']: header for header in headers}
-                else:
-                    operation['responses'] = {
-                        '204': {'description': HTTP_STATUS_CODES[204]}}
-
-                if view_func._spec.get('other_responses'):
-                    for status_code, response in view_func._spec.get(
-                            'other_responses').items():
-                        if not isinstance(response, (tuple, list)):
-                            response = (response,)
-                        operation['responses'][status_code] = {}
-                        for r in response:
-                            if isinstance(r, str):
-                                operation['responses'][status_code][
-                                    'description'] = r
-                            else:
-                                if isinstance(r, type):
-                                    r = r()  # instantiate the schema
-                                operation['responses'][status_code][
-                                    'content'] = {
-                                        'application/json': {
-                                            'schema': r
-                                        }
-                                    }
-                        if 'description' not in operation['responses'][
-                                status_code]:
+                }
+                if view_func._spec.get('response_stream'):
+                    # streamed responses can also be returned as
+                    # newline delimited JSON, with one object per line
+                    schema = copy(view_func._spec['response'])
+                    schema.many = False
+                    operation['responses'][code]['content'][
+                        'application/x-ndjson'] = {'schema': schema}
+                operation['responses'][code]['description'] = \
+                    view_func._spec['description'] or HTTP_STATUS_CODES[
+                        int(code)]
+                if view_func._spec.get('response_headers'):
+                    headers = schemas.parameters(
+                        view_func._spec['response_headers'], 'headers')
+                    operation['responses'][code]['headers'] = {
+                        header['name']: header for header in headers}
+            else:
+                operation['responses'] = {
+                    '204': {'description': HTTP_STATUS_CODES[204]}}
+
+            if view_func._spec.get('other_responses'):
+                for status_code, response in view_func._spec.get(
+                        'other_responses').items():
+                    if not isinstance(response, (tuple, list)):
+                        response = (response,)
+                    operation['responses'][status_code] = {}
+                    for r in response:
+                        if isinstance(r, str):
                             operation['responses'][status_code][
-                                'description'] = HTTP_STATUS_CODES[
-                                    int(status_code)]
-
-                if view_func._spec.get('body'):
-                    schema = view_func._spec.get('body')[0]
-                    location = view_func._spec.get('body')[1]
-                    media_type = view_func._spec.get('body')[2]
-                    if media_type is None and location == 'form':
-                        has_file = False
-                        for field in schema.dump_fields.values():
-                            if isinstance(field, apifairy_fields.FileField):
-                                has_file = True
-                                break
-                        media_type = 'application/x-www-form-urlencoded' \
-                            if not has_file else 'multipart/form-data'
-                    if media_type is None:
-                        media_type = 'application/json'
-                    operation['requestBody'] = {
-                        'content': {
-                            media_type: {
-                                'schema': schema,
-                            }
-                        },
-                        'required': True,
+                                'description'] = r
+                        else:
+                            operation['responses'][status_code][
+                                'content'] = {
+                                    'application/json': {
+                                        'schema': r
+                                    }
+                                }
+                    if 'description' not in operation['responses'][
+                            status_code]:
+                        operation['responses'][status_code][
+                            'description'] = HTTP_STATUS_CODES[
+                                int(status_code)]
+
+            if view_func._spec.get('body'):
+                schema = view_func._spec.get('body')[0]
+                location = view_func._spec.get('body')[1]
+                media_type = view_func._spec.get('body')[2]
+                if media_type is None and location == 'form':
+                    has_file = False
+                    for field in schema.dump_fields.values():
+                        if isinstance(field, apifairy_fields.FileField):
+                            has_file = True
+                            break
+                    media_type = 'application/x-www-form-urlencoded' \
+                        if not has_file else 'multipart/form-data'
+                if media_type is None:
+                    media_type = 'application/json'
+                operation['requestBody'] = {
+                    'content': {
+                        media_type: {
+                            'schema': schema,
+                        }
+                    },
+                    'required': True,
+                }
+
+            if view_func._spec.get('auth'):
+                operation['security'] = [{
+                    security[view_func._spec['auth']]: view_func._spec[
+                        'roles']
+                }]
+            operations[method.lower()] = operation
+
+        if is_endpoint:
+            path_arguments = _PATH_ARGUMENT_RE.findall(rule.rule)
+            if path_arguments:
+                annotations = view_func.__annotations__ or {}
+                arguments = []
+                for _, type_, name in path_arguments:
+                    argument = {
+                        'in': 'path',
+                        'name': name,
                     }
+                    if type_ == 'int:':
+                        argument['schema'] = {'type': 'integer'}
+                    elif type_ == 'float:':
+                        argument['schema'] = {'type': 'number'}
+                    else:
+                        argument['schema'] = {'type': 'string'}
+                    if isinstance(annotations.get(name), str):
+                        argument['description'] = annotations[name]
+                    elif _AnnotatedAlias and isinstance(
+                            annotations.get(name), _AnnotatedAlias):
+                        for annotation in annotations[name].__metadata__:
+                            if isinstance(annotation, str):
+                                argument['description'] = annotation
+                                break
+                    arguments.append(argument)
 
-                if view_func._spec.get('auth'):
-                    operation['security'] = [{
-                        security[view_func._spec['auth']]: view_func._spec[
-                            'roles']
-                    }]
-                operations[method.lower()] = operation
+                for method, operation in operations.items():
+                    operation['parameters'] = arguments + \
+                        operation['parameters']
 
-            if is_endpoint:
-                path_arguments = re.findall(r'<(([^<:]+:)?([^>]+))>',
-                                            rule.rule)
-                if path_arguments:
-                    annotations = view_func.__annotations__ or {}
-                    arguments = []
-                    for _, type_, name in path_arguments:
-                        argument = {
-                            'in': 'path',
-                            'name': name,
-                        }
-                        if type_ == 'int:':
-                            argument['schema'] = {'type': 'integer'}
-                        elif type_ == 'float:':
-                            argument['schema'] = {'type': 'number'}
-                        else:
-                            argument['schema'] = {'type': 'string'}
-                        if isinstance(annotations.get(name), str):
-                            argument['description'] = annotations[name]
-                        elif _AnnotatedAlias and isinstance(
-                                annotations.get(name), _AnnotatedAlias):
-                            for annotation in annotations[name].__metadata__:
-                                if isinstance(annotation, str):
-                                    argument['description'] = annotation
-                                    break
-                        arguments.append(argument)
-
-                    for method, operation in operations.items():
-                        operation['parameters'] = arguments + \
-                            operation['parameters']
-
-                path = re.sub(r'<([^<:]+:)?', '{', rule.rule).replace('>', '}')
-                if path not in paths:
-                    paths[path] = operations
-                else:
-                    paths[path].update(operations)
-            else:
-                # apispec does not support webhooks, so here they are added as
-                # paths, and later they are moved to their own section after
-                # the spec is generated
-                paths['webhook:' + endpoint] = operations
-        for path, operations in paths.items():
-            # sort by method before adding them to the spec
+        return operations
+
+    def _render_spec(self, state):
+        apispec = deepcopy(state.spec.to_dict())
+
+        # paths that were updated more than once may be out of order, so they
+        # are sorted again, along with their operations
+        paths = {}
+        for path in sorted(apispec['paths'], key=state.path_keys.get):
+            operations = apispec['paths'][path]
             sorted_operations = {}
             for method in ['get', 'post', 'put', 'patch', 'delete']:
                 if method in operations:
                     sorted_operations[method] = operations[method]
-            spec.path(path=path, operations=sorted_operations)
-
-        spec = spec.to_dict()
+            paths[path] = sorted_operations
+        apispec['paths'] = paths
 
         # extract webhooks from paths and add them to the webhooks section
         webhooks = {
-            path[8:]: operations for path, operations in spec['paths'].items()
+            path[8:]: operations for path, operations in paths.items()
             if path.startswith('webhook:')
         }
         if webhooks:
             paths = {
-                path: operations for path, operations in spec['paths'].items()
+                path: operations for path, operations in paths.items()
                 if not path.startswith('webhook:')
             }
-            spec['paths'] = paths
-            spec['webhooks'] = webhooks
-        return spec
+            apispec['paths'] = paths
+            apispec['webhooks'] = webhooks
+        return apispec
+
+
+def _spec_tags(apispec):
+    """Return the names of the tags used by the operations of a spec, in the
+    order given in its tags section."""
+    used = {}  # used as an ordered set
+    for section in ('paths', 'webhooks'):
+        for path_item in apispec.get(section, {}).values():
+            for method, operation in path_item.items():
+                if method in _PATH_ITEM_OPERATIONS:
+                    for tag in operation.get('tags', []):
+                        used[tag] = None
+    tags = [tag['name'] for tag in apispec.get('tags', [])
+            if tag['name'] in used]
+    return tags + [tag for tag in used if tag not in tags]
+
+
+def _tag_apispec(apispec, tag):
+    """Return a copy of a spec that only includes the operations with the
+    given tag, and the components that these operations reference."""
+    tag_apispec = {}
+    for key, value in apispec.items():
+        if key in ('paths', 'webhooks'):
+            value = {
+                path: {method: operation
+                       for method, operation in path_item.items()
+                       if method not in _PATH_ITEM_OPERATIONS or
+                       tag in operation.get('tags', [])}
+                for path, path_item in value.items()
+                if any(tag in operation.get('tags', [])
+                       for method, operation in path_item.items()
+                       if method in _PATH_ITEM_OPERATIONS)
+            }
+        elif key == 'tags':
+            value = [item for item in value if item['name'] == tag]
+            if not value:
+                continue
+        tag_apispec[key] = value
+    return _prune_components(tag_apispec)
+
+
+def _prune_components(apispec):
+    """Return a copy of a spec without the components that are not referenced
+    by its operations or by other referenced components."""
+    if 'components' not in apispec:
+        return apispec
+    pruned = {}
+    components = _referenced_components(
+        apispec['components'],
+        {key: value for key, value in apispec.items() if key != 'components'})
+    for key, value in apispec.items():
+        if key == 'components':
+            if not components:
+                continue
+            value = components
+        pruned[key] = value
+    return pruned
+
+
+def _referenced_components(components, data):
+    """Return the components that are referenced by the given data, either
+    directly or through other components."""
+    refs = set()
+    security = set()
+    stack = [data]
+    while stack:
+        value = stack.pop()
+        if isinstance(value, dict):
+            ref = value.get('$ref')
+            if isinstance(ref, str) and ref.startswith('#/components/'):
+                section, _, name = ref[13:].partition('/')
+                name = name.replace('~1', '/').replace('~0', '~')
+                if (section, name) not in refs and \
+                        name in components.get(section, {}):
+                    refs.add((section, name))
+                    stack.append(components[section][name])
+            if isinstance(value.get('security'), list):
+                for requirement in value['security']:
+                    if isinstance(requirement, dict):
+                        security.update(requirement)
+            stack.extend(value.values())
+        elif isinstance(value, list):
+            stack.extend(value)
+
+    referenced = {}
+    for section, items in components.items():
+        if section == 'securitySchemes':
+            # security schemes are referenced by name
+            items = {name: item for name, item in items.items()
+                     if name in security}
+        else:
+            items = {name: item for name, item in items.items()
+                     if (section, name) in refs}
+        if items:
+            referenced[section] = items
+    return referenced
+
+
+class _SpecState:
+    """The information needed to add new routes to a generated spec."""
+    def __init__(self, app, spec, ma_plugin, server_url, auto_server_url,
+                 tag_list, has_webhooks):
+        self.app = app
+        self.spec = spec
+        self.ma_plugin = ma_plugin
+        self.schemas = _SchemaCache(ma_plugin.converter)
+        self.server_url = server_url
+        self.auto_server_url = auto_server_url
+        self.tag_list = tag_list  # the tags list given in the spec options
+        self.has_webhooks = has_webhooks
+        self.rules = set()  # ids of the rules that are in the spec
+        self.endpoints = {}  # endpoint -> paths contributed by its rules
+        self.webhooks = {}  # webhook endpoint -> path contributed by it
+        self.webhooks_order = []
+        self.path_keys = {}  # path -> sort key
+        self.tag_names = set()
+        self.security = {}  # auth object -> security scheme name
+        self.security_names = set()
+        self.view_count = 0
+        self.rule_count = 0
+        self.webhook_count = 0
+
+    def is_stale(self):
+        # rules can be added for endpoints that already exist, so the number
+        # of rules is checked along with the number of view functions
+        return len(self.app.view_functions) != self.view_count or \
+            len(self.app.url_map._rules) != self.rule_count or \
+            len(_webhooks) != self.webhook_count
+
+
+class _SchemaCache:
+    """Convert marshmallow schemas to OpenAPI objects, reusing the result of
+    previous conversions of the same schema class and options."""
+    def __init__(self, converter):
+        self.converter = converter
+        self.schemas = {}  # schema key -> schema or reference object
+        self.parameters_cache = {}  # (schema key, location) -> parameters
+
+    @staticmethod
+    def _key(schema):
+        if isinstance(schema, Schema):
+            return make_schema_key(schema), bool(schema.many)
+        return schema  # schema class
+
+    def schema(self, schema):
+        if isinstance(schema, dict):
+            return schema
+        key = self._key(schema)
+        if key not in self.schemas:
+            self.schemas[key] = self.converter.resolve_nested_schema(
+                resolve_schema_instance(schema))
+        return self.schemas[key]
+
+    def parameters(self, schema, location):
+        key = (self._key(schema), location)
+        if key not in self.parameters_cache:
+            self.parameters_cache[key] = self.converter.schema2parameters(
+                resolve_schema_instance(schema), location=location)
+        return self.parameters_cache[key]
+
+    def resolve_operation(self, operation):
+        # schemas are resolved in the same order as apispec does it, so that
+        # components are added to the spec in the same order
+        parameters = []
+        for parameter in operation['parameters']:
+            if isinstance(parameter.get('schema', {}), dict):
+                parameters.append(parameter)
+            else:
+                parameters += self.parameters(parameter['schema'],
+                                              parameter['in'])
+        operation['parameters'] = parameters
+        if 'requestBody' in operation:
+            self._resolve_content(operation['requestBody'])
+        for response in operation['responses'].values():
+            self._resolve_content(response)
+
+    def _resolve_content(self, data):
+        for content in data.get('content', {}).values():
+            content['schema'] = self.schema(content['schema'])
@@ -1,9 +1,23 @@
 from functools import wraps
-
-from flask import current_app, Response
+from io import BytesIO
+from inspect import iscoroutinefunction
+from itertools import islice
+from time import perf_counter
+
+from flask import current_app, g, jsonify, request, Response, \
+    stream_with_context
+from flask.json import dumps as json_dumps
+from marshmallow import ValidationError as MarshmallowValidationError
+from webargs.core import _UNKNOWN_DEFAULT_PARAM
 from webargs.flaskparser import FlaskParser as BaseFlaskParser
+from werkzeug.utils import import_string
 
+from apifairy.compiler import compile_loader, compile_schema
 from apifairy.exceptions import ValidationError
+from apifairy.fields import FileField
+from apifairy.multipart import parse_multipart
+from apifairy.pagination import page_schema, paginate, \
+    pagination_arguments_schema
 
 
 class FlaskParser(BaseFlaskParser):
@@ -11,9 +25,120 @@ class FlaskParser(BaseFlaskParser):
     DEFAULT_VALIDATION_STATUS = 400
 
     def load_form(self, req, schema):
+        if req.mimetype == 'multipart/form-data':
+            stream_fields = {
+                field.data_key or name: field.max_size
+                for name, field in schema.load_fields.items()
+                if isinstance(field, FileField) and field.stream}
+            if stream_fields:
+                return self._makeproxy(parse_multipart(req, stream_fields),
+                                       schema)
         return {**self.load_files(req, schema),
                 **super().load_form(req, schema)}
 
+    def parse_all(self, inputs, req=None, durations=None):
+        """Parse several argmaps, each from its own location, in one pass.
+
+        ``inputs`` is a sequence of ``(argmap, location, kwargs)`` tuples,
+        where ``kwargs`` are the keyword arguments accepted by ``parse()``,
+        plus optional ``max_content_length`` and ``max_items`` limits, and
+        an optional ``loader`` function returned by ``compile_loader()``. The
+        parsed data for each input is returned in a list. Validation errors
+        from all the inputs are merged, keyed by location, and given to the
+        error handler in a single call. Inputs that exceed their limits are
+        rejected with a 413 status code before they are validated. If a
+        ``durations`` list is given, the time spent on each input is appended
+        to it.
+        """
+        req = req if req is not None else self.get_default_request()
+        results = []
+        errors = {}
+        error_args = None
+        for argmap, location, kwargs in inputs:
+            schema = argmap
+            if durations is not None:
+                start = perf_counter()
+            try:
+                loader = kwargs.get('loader')
+                if loader is not None:
+                    # compiled query string loader
+                    results.append(loader(req.args))
+                    continue
+                unknown = kwargs.get('unknown', _UNKNOWN_DEFAULT_PARAM)
+                _, _, location, validators, schema = self._prepare_for_parse(
+                    argmap, req, location, unknown, kwargs.get('validate'))
+                max_content_length = kwargs.get('max_content_length')
+                if max_content_length is not None:
+                    self._limit_content_length(req, schema, location,
+                                               max_content_length)
+                location_data = self._load_location_data(
+                    schema=schema, req=req, location=location)
+                max_items = kwargs.get('max_items')
+                if max_items is not None and \
+                        isinstance(location_data, list) and \
+                        len(location_data) > max_items:
+                    self._reject(req, schema, location, 'Too many items.')
+                results.append(self._process_location_data(
+                    location_data, schema, req, location, unknown,
+                    validators))
+            except MarshmallowValidationError as error:
+                self._merge_error(errors, location, error)
+                if error_args is None:
+                    error_args = (schema, kwargs.get('error_status_code'),
+                                  kwargs.get('error_headers'))
+                results.append(None)
+            finally:
+                if durations is not None:
+                    durations.append(perf_counter() - start)
+        if errors:
+            schema, error_status_code, error_headers = error_args
+            error_handler = self.error_callback or self.handle_error
+            error_handler(MarshmallowValidationError(errors), req, schema,
+                          error_status_code=error_status_code,
+                          error_headers=error_headers)
+            raise ValueError(
+                'The error handler did not raise an exception')
+        return results
+
+    def _merge_error(self, errors, location, error):
+        messages = errors.get(location)
+        if isinstance(messages, dict) and isinstance(error.messages, dict):
+            messages.update(error.messages)
+        else:
+            errors[location] = error.messages
+
+    def _limit_content_length(self, req, schema, location,
+                              max_content_length):
+        if req.content_length is not None:
+            if req.content_length > max_content_length:
+                self._reject(req, schema, location,
+                             'Request body is too large.')
+        elif req.max_content_length is None or \
+                req.max_content_length > max_content_length:
+            # the length of the body is not known in advance, so it is read
+            # up to one byte past the limit to find out if it is too large
+            try:
+                req.max_content_length = max_content_length + 1
+            except AttributeError:
+                # Flask < 3.1 does not allow the limit of the request to be
+                # changed, so the body is read from the stream, which is then
+                # replaced with the data that was read
+                data = req.stream.read(max_content_length + 1)
+                req.__dict__['stream'] = BytesIO(data)
+                size = len(data)
+            else:
+                size = len(req.get_data(cache=True))
+            if size > max_content_length:
+                self._reject(req, schema, location,
+                             'Request body is too large.')
+
+    def _reject(self, req, schema, location, message):
+        error_handler = self.error_callback or self.handle_error
+        error_handler(MarshmallowValidationError(
+                          {location: {'_schema': [message]}}),
+                      req, schema, error_status_code=413, error_headers=None)
+        raise ValueError('The error handler did not raise an exception')
+
     def handle_error(self, error, req, schema, *, error_status_code,
                      error_headers):
         raise ValidationError(
@@ -26,19 +151,226 @@ use_args = parser.use_args
 _webhooks = {}
 
 
-def _ensure_sync(f):
-    if hasattr(f, '_sync_ensured'):
-        return f
+def _jsonify(schema, data, dump=None):
+    apifairy = current_app.extensions.get('apifairy')
+    encoder = apifairy.json_encoder if apifairy else None
+    if dump is None:
+        if encoder is None:
+            return schema.jsonify(data)
+        dump = schema.dump
+    if encoder is None:
+        return jsonify(dump(data))
+    if isinstance(encoder, str):
+        encoder = apifairy.json_encoder = import_string(encoder)
+    return current_app.response_class(encoder(dump(data)),
+                                      mimetype='application/json')
+
+
+def _stream_jsonify(schema, data, dump=None, chunk_size=100):
+    apifairy = current_app.extensions.get('apifairy')
+    encoder = apifairy.json_encoder if apifairy else None
+    if encoder is None:
+        encoder = json_dumps
+    elif isinstance(encoder, str):
+        encoder = apifairy.json_encoder = import_string(encoder)
+    dump = dump or schema.dump
+    ndjson = request.accept_mimetypes.best_match(
+        ['application/json', 'application/x-ndjson']) == \
+        'application/x-ndjson'
+
+    def generate():
+        # objects are dumped and encoded in chunks, so that only one chunk
+        # needs to be in memory at a time
+        items = iter(data)
+        separator = b'' if ndjson else b'['
+        while True:
+            chunk = list(islice(items, chunk_size))
+            if not chunk:
+                break
+            for item in dump(chunk, many=True):
+                item = encoder(item)
+                if isinstance(item, str):
+                    item = item.encode()
+                if ndjson:
+                    yield item + b'\n'
+                else:
+                    yield separator + item
+                    separator = b','
+        if not ndjson:
+            yield b']' if separator == b',' else b'[]'
+
+    return current_app.response_class(
+        stream_with_context(generate()),
+        mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+
+def _make_response(rv, serialize, status_code, decorator_name):
+    if isinstance(rv, Response):  # pragma: no cover
+        raise RuntimeError(
+            f'The {decorator_name} decorator cannot handle Response objects.')
+    if isinstance(rv, tuple):
+        json = serialize(rv[0])
+        if len(rv) == 2:
+            if not isinstance(rv[1], int):
+                rv = (json, status_code, rv[1])
+            else:
+                rv = (json, rv[1])
+        elif len(rv) >= 3:
+            rv = (json, rv[1], rv[2])
+        else:
+            rv = (json, status_code)
+        return rv
+    else:
+        return serialize(rv), status_code
+
+
+def _parse_inputs(inputs, as_kwargs, args, kwargs, phases=None,
+                  timings=None):
+    durations = None
+    if timings is not None:
+        durations = []
+    try:
+        results = parser.parse_all(inputs, durations=durations)
+    finally:
+        if durations:
+            for phase, duration in zip(phases, durations):
+                timings[phase] = timings.get(phase, 0) + duration
+    for location_args, location_as_kwargs in zip(results, as_kwargs):
+        if callable(location_as_kwargs):
+            # the arguments are used by a decorator instead of the view
+            location_as_kwargs(location_args)
+            continue
+        if location_as_kwargs:
+            kwargs.update(location_args)
+            location_args = {}
+        args += (location_args,)
+    return args
+
+
+def _get_metrics_callback():
+    apifairy = current_app.extensions.get('apifairy')
+    return apifairy.metrics_callback if apifairy else None
+
+
+def _begin_timings():
+    # a view can have more than one dispatcher when other decorators are
+    # applied between the apifairy decorators, so the timings of all of them
+    # are added to a dictionary shared through the request, which is
+    # reported by the outermost dispatcher
+    timings = g.get('_apifairy_timings')
+    if timings is not None:
+        return timings, False
+    timings = g._apifairy_timings = {}
+    return timings, True
+
+
+def _end_timings(metrics, timings, outermost):
+    if outermost:
+        del g._apifairy_timings
+        metrics(request.endpoint, timings)
+
+
+def _record_handler_time(timings, start, previous):
+    # the phases of the dispatchers nested inside the view are already
+    # recorded, so only the time spent outside of them is added to the
+    # handler phase, unless a nested dispatcher failed before the view
+    # function was reached
+    nested = sum(timings.values()) - previous
+    if nested == 0 or 'handler' in timings:
+        timings['handler'] = timings.get('handler', 0) + \
+            perf_counter() - start - nested
+
+
+def _dispatcher(f, input=None, output=None):
+    # the inputs and the output of the view are merged into the dispatcher
+    # that is already wrapping it, so that the view runs under a single
+    # wrapper regardless of how many decorators are applied to it
+    view, inputs = f, ()
+    if getattr(f, '_dispatcher', None) is f:
+        view, inputs, output = f._view, f._inputs, output or f._output
+    if input is not None:
+        # the outermost decorator provides the first positional argument
+        inputs = (input,) + inputs
+    parse_inputs = tuple(input[:3] for input in inputs)
+    as_kwargs = tuple(input[3] for input in inputs)
+    phases = tuple(input[4] for input in inputs)
+
+    if iscoroutinefunction(view):
+        @wraps(f)
+        async def dispatcher(*args, **kwargs):
+            metrics = _get_metrics_callback()
+            if metrics is None:
+                if inputs:
+                    args = _parse_inputs(parse_inputs, as_kwargs, args,
+                                         kwargs)
+                rv = await view(*args, **kwargs)
+                return rv if output is None else output(rv)
+
+            timings, outermost = _begin_timings()
+            try:
+                if inputs:
+                    args = _parse_inputs(parse_inputs, as_kwargs, args,
+                                         kwargs, phases, timings)
+                previous = sum(timings.values())
+                start = perf_counter()
+                try:
+                    rv = await view(*args, **kwargs)
+                finally:
+                    _record_handler_time(timings, start, previous)
+                if output is not None:
+                    start = perf_counter()
+                    rv = output(rv)
+                    timings['response'] = timings.get('response', 0) + \
+                        perf_counter() - start
+                return rv
+            finally:
+                _end_timings(metrics, timings, outermost)
+    else:
+        @wraps(f)
+        def dispatcher(*args, **kwargs):
+            metrics = _get_metrics_callback()
+            if metrics is None:
+                if inputs:
+                    args = _parse_inputs(parse_inputs, as_kwargs, args,
+                                         kwargs)
+                rv = view(*args, **kwargs)
+                return rv if output is None else output(rv)
+
+            timings, outermost = _begin_timings()
+            try:
+                if inputs:
+                    args = _parse_inputs(parse_inputs, as_kwargs, args,
+                                         kwargs, phases, timings)
+                previous = sum(timings.values())
+                start = perf_counter()
+                try:
+                    rv = view(*args, **kwargs)
+                finally:
+                    _record_handler_time(timings, start, previous)
+                if output is not None:
+                    start = perf_counter()
+                    rv = output(rv)
+                    timings['response'] = timings.get('response', 0) + \
+                        perf_counter() - start
+                return rv
+            finally:
+                _end_timings(metrics, timings, outermost)
 
-    @wraps(f)
-    def wrapper(*args, **kwargs):
-        if hasattr(current_app, 'ensure_sync'):
-            return current_app.ensure_sync(f)(*args, **kwargs)
-        else:  # pragma: no cover
-            return f(*args, **kwargs)
+    dispatcher.__wrapped__ = view
+    dispatcher._dispatcher = dispatcher
+    dispatcher._view = view
+    dispatcher._inputs = inputs
+    dispatcher._output = output
+    return dispatcher
 
-    wrapper._sync_ensured = True
-    return wrapper
+
+def _input(schema, location, kwargs, phase, consumer=None):
+    # arg_name only applies to webargs' use_args decorator, which is not used
+    kwargs = {key: value for key, value in kwargs.items()
+              if key != 'arg_name'}
+    as_kwargs = kwargs.pop('as_kwargs', False)
+    # a consumer function receives the parsed data instead of the view
+    return schema, location, kwargs, consumer or as_kwargs, phase
 
 
 def _annotate(f, **kwargs):
@@ -53,88 +385,132 @@ def authenticate(auth, **kwargs):
         roles = kwargs.get('role')
         if not isinstance(roles, list):  # pragma: no cover
             roles = [roles] if roles is not None else []
-        f = _ensure_sync(f)
         _annotate(f, auth=auth, roles=roles)
         return auth.login_required(**kwargs)(f)
     return decorator
 
 
-def arguments(schema, location='query', **kwargs):
+def arguments(schema, location='query', compiled=False, **kwargs):
     if isinstance(schema, type):  # pragma: no cover
         schema = schema()
+    if compiled and location in ('query', 'querystring') and \
+            'unknown' not in kwargs and 'validate' not in kwargs:
+        loader = compile_loader(schema)
+        if loader is not None:
+            kwargs['loader'] = loader
 
     def decorator(f):
-        f = _ensure_sync(f)
         if not hasattr(f, '_spec') or f._spec.get('args') is None:
             _annotate(f, args=[])
         f._spec['args'].append((schema, location))
-        arg_name = f'{location}_{schema.__class__.__name__}_args'
+        return _dispatcher(f, input=_input(schema, location, kwargs,
+                                           'arguments'))
+    return decorator
 
-        @wraps(f)
-        def _f(*args, **kwargs):
-            location_args = kwargs.pop(arg_name, {})
-            return f(*args, location_args, **kwargs)
 
-        return use_args(schema, location=location, arg_name=arg_name,
-                        **kwargs)(_f)
-    return decorator
+def _check_stream_fields(schema):
+    # the parts of a multipart request that follow a streamed file are not
+    # parsed, so the streamed file must be the last field of the schema
+    names = [name for name, field in schema.load_fields.items()
+             if isinstance(field, FileField) and field.stream]
+    if len(names) > 1:
+        raise ValueError('A schema cannot have more than one streamed file '
+                         'field')
+    if names and names[0] != list(schema.load_fields)[-1]:
+        raise ValueError(f'The streamed file field "{names[0]}" must be the '
+                         'last field of the schema')
 
 
-def body(schema, location='json', media_type=None, **kwargs):
+def body(schema, location='json', media_type=None, max_content_length=None,
+         max_items=None, **kwargs):
     if isinstance(schema, type):  # pragma: no cover
         schema = schema()
+    _check_stream_fields(schema)
+    if max_content_length is None:
+        max_content_length = getattr(schema.Meta, 'max_content_length', None)
+    if max_items is None:
+        max_items = getattr(schema.Meta, 'max_items', None)
+    if max_content_length is not None:
+        kwargs['max_content_length'] = max_content_length
+    if max_items is not None:
+        kwargs['max_items'] = max_items
 
     def decorator(f):
-        f = _ensure_sync(f)
         _annotate(f, body=(schema, location, media_type))
-        arg_name = f'{location}_{schema.__class__.__name__}_args'
-
-        @wraps(f)
-        def _f(*args, **kwargs):
-            location_args = kwargs.pop(arg_name, {})
-            return f(*args, location_args, **kwargs)
-
-        return use_args(schema, location=location, arg_name=arg_name,
-                        **kwargs)(_f)
+        return _dispatcher(f, input=_input(schema, location, kwargs, 'body'))
     return decorator
 
 
-def response(schema, status_code=200, description=None, headers=None):
+def response(schema, status_code=200, description=None, headers=None,
+             compiled=False, stream=False, chunk_size=100):
     if isinstance(schema, type):  # pragma: no cover
         schema = schema()
+    if stream and not schema.many:
+        raise ValueError('Streaming responses require a schema with '
+                         'many=True')
+    dump = compile_schema(schema) if compiled else None
+    if stream:
+        def serialize(data):
+            return _stream_jsonify(schema, data, dump, chunk_size)
+    else:
+        def serialize(data):
+            return _jsonify(schema, data, dump)
+
+    def make_response(rv):
+        return _make_response(rv, serialize, status_code, '@response')
 
     def decorator(f):
-        f = _ensure_sync(f)
         _annotate(f, response=schema, status_code=status_code,
-                  description=description, response_headers=headers)
+                  description=description, response_headers=headers,
+                  response_stream=stream)
 
-        @wraps(f)
-        def _response(*args, **kwargs):
-            rv = f(*args, **kwargs)
-            if isinstance(rv, Response):  # pragma: no cover
-                raise RuntimeError(
-                    'The @response decorator cannot handle Response objects.')
-            if isinstance(rv, tuple):
-                json = schema.jsonify(rv[0])
-                if len(rv) == 2:
-                    if not isinstance(rv[1], int):
-                        rv = (json, status_code, rv[1])
-                    else:
-                        rv = (json, rv[1])
-                elif len(rv) >= 3:
-                    rv = (json, rv[1], rv[2])
-                else:
-                    rv = (json, status_code)
-                return rv
-            else:
-                return schema.jsonify(rv), status_code
-        return _response
+        return _dispatcher(f, output=make_response)
+    return decorator
+
+
+def paginated_response(schema, key='id', limit=20, max_limit=100,
+                       descending=False, status_code=200, description=None,
+                       headers=None, compiled=False):
+    if isinstance(schema, type):  # pragma: no cover
+        schema = schema()
+    if schema.many:
+        raise ValueError('Paginated responses require a schema with '
+                         'many=False')
+    envelope = page_schema(schema)
+    args_schema = pagination_arguments_schema(limit, max_limit)
+    dump = compile_schema(envelope) if compiled else None
+
+    def store_args(args):
+        # the pagination arguments are parsed along with the other inputs of
+        # the view, but they are only needed when its response is serialized
+        g._apifairy_pagination = args
+
+    def serialize(data):
+        args = g.pop('_apifairy_pagination')
+        page = paginate(data, key, args['limit'], args.get('cursor'),
+                        descending)
+        return _jsonify(envelope, page, dump)
+
+    def make_response(rv):
+        return _make_response(rv, serialize, status_code,
+                              '@paginated_response')
+
+    def decorator(f):
+        if not hasattr(f, '_spec') or f._spec.get('args') is None:
+            _annotate(f, args=[])
+        f._spec['args'].append((args_schema, 'query'))
+        _annotate(f, response=envelope, status_code=status_code,
+                  description=description, response_headers=headers,
+                  response_stream=False)
+
+        return _dispatcher(f, input=_input(args_schema, 'query', {},
+                                           'arguments', consumer=store_args),
+                           output=make_response)
     return decorator
 
 
 def other_responses(responses):
     def decorator(f):
-        f = _ensure_sync(f)
         _annotate(f, other_responses=responses)
         return f
     return decorator
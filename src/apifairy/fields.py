@@ -4,7 +4,18 @@ from werkzeug.datastructures import FileStorage
 
 
 class FileField(Field):
+    def __init__(self, *, stream=False, max_size=None, **kwargs):
+        super().__init__(**kwargs)
+        self.stream = stream
+        self.max_size = max_size
+
     def _deserialize(self, value, attr, data, **kwargs):
         if not isinstance(value, FileStorage):
             raise ValidationError('Not a file.')
+        if self.max_size is not None and value.stream.seekable():
+            position = value.stream.tell()
+            size = value.stream.seek(0, 2)
+            value.stream.seek(position)
+            if size > self.max_size:
+                raise ValidationError('File is too large.')
         return value
@@ -0,0 +1,136 @@
+from io import RawIOBase
+
+from werkzeug.datastructures import FileStorage, MultiDict
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import default_stream_factory
+from werkzeug.sansio.multipart import Data, Epilogue, Field, File, \
+    MultipartDecoder, NeedData
+
+from apifairy.exceptions import ValidationError
+
+
+class MultipartFileReader(RawIOBase):
+    """A read-only file object that returns the contents of a file part of a
+    multipart request as it is read from the client.
+
+    Reading more than ``max_size`` bytes raises a validation error with a 413
+    status code.
+    """
+    def __init__(self, decoder, stream, name, max_size=None,
+                 buffer_size=64 * 1024):
+        self.decoder = decoder
+        self.stream = stream
+        self.name = name
+        self.max_size = max_size
+        self.buffer_size = buffer_size
+        self.size = 0
+        self.buffer = bytearray()
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer and not self.done:
+            self._receive()
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        del self.buffer[:n]
+        return n
+
+    def _receive(self):
+        try:
+            event = self.decoder.next_event()
+            while isinstance(event, NeedData):
+                self.decoder.receive_data(
+                    self.stream.read(self.buffer_size) or None)
+                event = self.decoder.next_event()
+        except ValueError:
+            # the request body is malformed or incomplete
+            self.done = True
+            raise ValidationError(400, {'form': {
+                self.name: ['Invalid file.']}})
+        if not isinstance(event, Data):  # pragma: no cover
+            self.done = True
+            return
+        self.size += len(event.data)
+        if self.max_size is not None and self.size > self.max_size:
+            self.done = True
+            raise ValidationError(413, {'form': {
+                self.name: ['File is too large.']}})
+        self.buffer += event.data
+        self.done = not event.more_data
+
+
+def parse_multipart(req, stream_fields, buffer_size=64 * 1024):
+    """Parse a multipart request without buffering streamed files.
+
+    The parts of the request are parsed in order until the first file part
+    named in ``stream_fields``, which maps field names to size limits. This
+    file is returned as a ``FileStorage`` object backed by a
+    :class:`MultipartFileReader`, so it can be read by the view function
+    directly from the client connection. Any parts that follow the streamed
+    file are not parsed.
+
+    As with werkzeug's form parser, a malformed request gives an empty form.
+    """
+    boundary = req.mimetype_params.get('boundary', '').encode('latin1')
+    if not boundary:
+        return MultiDict()
+    try:
+        return _parse_parts(req, stream_fields, boundary, buffer_size)
+    except ValueError:
+        return MultiDict()
+
+
+def _parse_parts(req, stream_fields, boundary, buffer_size):
+    decoder = MultipartDecoder(boundary,
+                               max_form_memory_size=req.max_form_memory_size,
+                               max_parts=req.max_form_parts)
+    stream = req.stream
+    form = MultiDict()
+    part = container = None
+    field_size = 0
+
+    while True:
+        event = decoder.next_event()
+        if isinstance(event, NeedData):
+            decoder.receive_data(stream.read(buffer_size) or None)
+        elif isinstance(event, Epilogue):
+            break
+        elif isinstance(event, File) and event.name in stream_fields:
+            reader = MultipartFileReader(decoder, stream, event.name,
+                                         stream_fields[event.name],
+                                         buffer_size)
+            form.add(event.name, FileStorage(reader, event.filename,
+                                             event.name,
+                                             headers=event.headers))
+            break
+        elif isinstance(event, Field):
+            part = event
+            container = []
+            field_size = 0
+        elif isinstance(event, File):
+            part = event
+            container = default_stream_factory(
+                total_content_length=req.content_length,
+                content_type=event.headers.get('content-type'),
+                filename=event.filename)
+        elif isinstance(event, Data):
+            if isinstance(part, Field):
+                field_size += len(event.data)
+                if req.max_form_memory_size is not None and \
+                        field_size > req.max_form_memory_size:
+                    raise RequestEntityTooLarge()
+                container.append(event.data)
+                if not event.more_data:
+                    form.add(part.name, b''.join(container).decode(
+                        'utf-8', 'replace'))
+            else:
+                container.write(event.data)
+                if not event.more_data:
+                    container.seek(0)
+                    form.add(part.name, FileStorage(
+                        container, part.filename, part.name,
+                        headers=part.headers))
+    return form
@@ -0,0 +1,184 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections.abc import Mapping
+from datetime import date, datetime
+from decimal import Decimal
+from itertools import islice
+from json import dumps, loads
+from uuid import UUID
+
+from apispec.ext.marshmallow.common import make_schema_key
+from flask_marshmallow import Schema
+from marshmallow import fields, validate, ValidationError
+
+from apifairy.exceptions import ValidationError as APIFairyValidationError
+
+
+def encode_cursor(value):
+    """Return an opaque cursor string for the given key value."""
+    if isinstance(value, datetime):
+        value = ['datetime', value.isoformat()]
+    elif isinstance(value, date):
+        value = ['date', value.isoformat()]
+    elif isinstance(value, UUID):
+        value = ['uuid', str(value)]
+    elif isinstance(value, Decimal):
+        value = ['decimal', str(value)]
+    else:
+        value = ['value', value]
+    return urlsafe_b64encode(dumps(value, separators=(',', ':')).encode()) \
+        .decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return the key value stored in a cursor string.
+
+    A ``ValueError`` is raised if the cursor is invalid.
+    """
+    try:
+        value_type, value = loads(urlsafe_b64decode(
+            cursor + '=' * (-len(cursor) % 4)))
+        if value_type == 'datetime':
+            return datetime.fromisoformat(value)
+        elif value_type == 'date':
+            return date.fromisoformat(value)
+        elif value_type == 'uuid':
+            return UUID(value)
+        elif value_type == 'decimal' and isinstance(value, str):
+            value = Decimal(value)
+            if value.is_finite():
+                return value
+        elif value_type == 'value':
+            return value
+    except (TypeError, ValueError, ArithmeticError):
+        pass
+    raise ValueError('Invalid cursor')
+
+
+class Cursor(fields.String):
+    """A field that loads the key value stored in a pagination cursor."""
+    def _deserialize(self, value, attr, data, **kwargs):
+        try:
+            return decode_cursor(super()._deserialize(value, attr, data,
+                                                      **kwargs))
+        except ValueError:
+            raise ValidationError('Invalid cursor.')
+
+
+class PaginationSchema(Schema):
+    limit = fields.Integer(
+        metadata={'description': 'The maximum number of items in the page.'})
+    next_cursor = fields.String(
+        allow_none=True, metadata={
+            'description': 'The cursor to request the next page, or null if '
+            'this is the last page.'})
+
+
+def pagination_arguments_schema(limit, max_limit):
+    """Return a schema for the query string arguments of a paginated
+    endpoint."""
+    return Schema.from_dict({
+        'limit': fields.Integer(
+            load_default=limit, validate=validate.Range(min=1, max=max_limit),
+            metadata={'description': 'The maximum number of items to '
+                      'return.'}),
+        'cursor': Cursor(metadata={
+            'description': 'The cursor returned with the previous page. If '
+            'not given, the first page is returned.'}),
+    }, name='PaginationArguments')()
+
+
+_page_schemas = {}  # item schema key -> page schema
+
+
+def page_schema(schema):
+    """Return a schema for pages of items serialized with the given schema.
+
+    The name of the page schema is derived from the name of the item schema,
+    so ``UserSchema`` gives ``UserPageSchema``. Item schemas with the same
+    class and options share the same page schema, so that it appears only
+    once in the documentation.
+    """
+    key = make_schema_key(schema)
+    if key not in _page_schemas:
+        name = type(schema).__name__
+        if name.endswith('Schema'):
+            name = name[:-6] or name
+        _page_schemas[key] = type(f'{name}PageSchema', (Schema,), {
+            'data': fields.List(fields.Nested(schema)),
+            'pagination': fields.Nested(PaginationSchema),
+        })()
+    return _page_schemas[key]
+
+
+def _invalid_cursor():
+    return APIFairyValidationError(400, {'query': {
+        'cursor': ['Invalid cursor.']}})
+
+
+def _is_orderable(value):
+    try:
+        value < value
+    except TypeError:
+        return False
+    return True
+
+
+def _get_key(item, key):
+    if isinstance(item, Mapping):
+        return item[key]
+    return getattr(item, key)
+
+
+def paginate(data, key, limit, cursor=None, descending=False):
+    """Return a page of items from a collection that is sorted by the given
+    key, using keyset pagination.
+
+    The collection can be a SQLAlchemy query, which is then sorted and
+    filtered by the key column, or any iterable of objects or dictionaries
+    that is already sorted by the key. Only the items that come after the
+    key value given in ``cursor`` are included in the page.
+
+    A validation error is raised if the cursor holds a value that cannot be
+    compared with the keys of the collection.
+    """
+    if hasattr(data, 'column_descriptions'):
+        # SQLAlchemy query
+        column = getattr(data.column_descriptions[0]['entity'], key)
+        if cursor is not None:
+            try:
+                python_type = column.type.python_type
+            except NotImplementedError:  # pragma: no cover
+                python_type = object
+            if python_type is float:
+                python_type = (int, float)
+            if not isinstance(cursor, python_type):
+                raise _invalid_cursor()
+            data = data.filter(column < cursor if descending
+                               else column > cursor)
+        data = data.order_by(None).order_by(
+            column.desc() if descending else column)
+        items = data.limit(limit + 1).all()
+    else:
+        items = iter(data)
+        if cursor is not None:
+            for item in items:
+                value = _get_key(item, key)
+                try:
+                    found = value < cursor if descending else value > cursor
+                except TypeError:
+                    if not _is_orderable(value):
+                        raise  # the key of the item cannot be compared
+                    raise _invalid_cursor()
+                if found:
+                    items = [item] + list(islice(items, limit))
+                    break
+            else:
+                items = []
+        else:
+            items = list(islice(items, limit + 1))
+    next_cursor = None
+    if len(items) > limit:
+        items = items[:limit]
+        next_cursor = encode_cursor(_get_key(items[-1], key))
+    return {'data': items,
+            'pagination': {'limit': limit, 'next_cursor': next_cursor}}
@@ -1,20 +1,37 @@
+from datetime import date, datetime
+from decimal import Decimal
+from enum import Enum
+import gzip
+from inspect import iscoroutinefunction, signature
 from io import BytesIO
+import json
+import os
 import sys
+import tempfile
 try:
     from typing import Annotated
 except ImportError:
     Annotated = None
 import unittest
+from unittest import mock
+from uuid import UUID
 import pytest
 
-from flask import Flask, Blueprint, request, session, abort
+from flask import Flask, Blueprint, request, session, abort, \
+    render_template
 from flask_httpauth import HTTPBasicAuth, HTTPTokenAuth
 from flask_marshmallow import Marshmallow
-from marshmallow import EXCLUDE
+from marshmallow import EXCLUDE, post_dump, post_load, validate
 from openapi_spec_validator import validate_spec
+from webargs.flaskparser import FlaskParser
+from werkzeug.test import EnvironBuilder
 
 from apifairy import APIFairy, body, arguments, response, authenticate, \
-    other_responses, webhook, FileField
+    other_responses, paginated_response, webhook, FileField
+from apifairy.compiler import compile_loader, compile_schema
+from apifairy.decorators import parser
+from apifairy.exceptions import ValidationError
+from apifairy.pagination import decode_cursor, encode_cursor, paginate
 
 ma = Marshmallow()
 
@@ -64,6 +81,29 @@ class HeaderSchema(ma.Schema):
     x_token = ma.Str(data_key='X-Token', required=True)
 
 
+class NestedSchema(ma.Schema):
+    id = ma.Integer(dump_only=True)
+    price = ma.Float(attribute='cost')
+    code = ma.Str(data_key='Code')
+    owner = ma.Nested(FooSchema, allow_none=True)
+    children = ma.List(ma.Nested(Schema2(only=['id2'])))
+    parent_name = ma.Str(attribute='parent.name')
+    secret = ma.Str(load_only=True)
+    flag = ma.Boolean()
+    total = ma.Method('get_total')
+
+    def get_total(self, obj):
+        return len(obj.get('children', []))
+
+
+class HookSchema(ma.Schema):
+    name = ma.Str()
+
+    @post_dump
+    def upper(self, data, **kwargs):
+        return {'name': data['name'].upper()}
+
+
 class TestAPIFairy(unittest.TestCase):
     def create_app(self, config=None):
         app = Flask(__name__)
@@ -122,6 +162,279 @@ class TestAPIFairy(unittest.TestCase):
         assert rv.status_code == 200
         assert b'redoc.standalone.js' in rv.data
 
+    def test_apispec_etag(self):
+        app, apifairy = self.create_app(config={
+            'APIFAIRY_APISPEC_CACHE_CONTROL': 'max-age=60'})
+
+        client = app.test_client()
+        rv = client.get('/apispec.json')
+        assert rv.status_code == 200
+        assert rv.headers['Content-Type'] == 'application/json'
+        assert rv.headers['Cache-Control'] == 'max-age=60'
+        etag = rv.headers['ETag']
+        assert etag.startswith('"') and not etag.startswith('W/')
+
+        rv2 = client.get('/apispec.json')
+        assert rv2.headers['ETag'] == etag
+        assert rv2.data == rv.data
+
+        rv = client.get('/apispec.json', headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert rv.data == b''
+
+        rv = client.get('/apispec.json', headers={'If-None-Match': '"foo"'})
+        assert rv.status_code == 200
+
+    def test_apispec_compression(self):
+        app, apifairy = self.create_app()
+
+        client = app.test_client()
+        rv = client.get('/apispec.json')
+        assert rv.status_code == 200
+        assert 'Content-Encoding' not in rv.headers
+        assert rv.headers['Vary'] == 'Accept-Encoding'
+        data = rv.data
+        etag = rv.headers['ETag']
+
+        rv = client.get('/apispec.json', headers={'Accept-Encoding': 'gzip'})
+        assert rv.status_code == 200
+        assert rv.headers['Content-Encoding'] == 'gzip'
+        assert rv.headers['ETag'] != etag
+        assert gzip.decompress(rv.data) == data
+        gzip_etag = rv.headers['ETag']
+
+        rv = client.get('/apispec.json', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': gzip_etag})
+        assert rv.status_code == 304
+
+        rv = client.get('/apispec.json', headers={
+            'Accept-Encoding': 'deflate'})
+        assert rv.status_code == 200
+        assert 'Content-Encoding' not in rv.headers
+        assert rv.data == data
+
+        app, apifairy = self.create_app(config={
+            'APIFAIRY_APISPEC_COMPRESSION': False})
+        client = app.test_client()
+        rv = client.get('/apispec.json', headers={'Accept-Encoding': 'gzip'})
+        assert rv.status_code == 200
+        assert 'Content-Encoding' not in rv.headers
+        assert 'Vary' not in rv.headers
+
+    def test_build_spec(self):
+        app, apifairy = self.create_app()
+
+        @app.route('/foo')
+        @response(Schema)
+        def foo():
+            pass
+
+        apispec = apifairy.build_spec(app,
+                                      server_url='https://example.com/api/')
+        validate_spec(apispec)
+        assert apispec['servers'] == [{'url': 'https://example.com/api/'}]
+        assert '/foo' in apispec['paths']
+        assert apifairy.apispec is apispec
+        assert 'gzip' in apifairy._apispec_payload.variants
+
+        client = app.test_client()
+        rv = client.get('/apispec.json')
+        assert rv.status_code == 200
+        assert rv.json['servers'] == [{'url': 'https://example.com/api/'}]
+
+        with app.app_context():
+            apispec = apifairy.build_spec()
+        assert apispec['servers'] == [{'url': '/'}]
+
+        with mock.patch('apifairy.core.dumps', wraps=json.dumps) as dumps:
+            rv = client.get('/apispec.json', base_url='http://foo.com',
+                            headers={'Accept-Encoding': 'gzip'})
+            assert rv.status_code == 200
+            assert rv.headers['Content-Encoding'] == 'gzip'
+            assert json.loads(gzip.decompress(rv.data))['servers'] == [
+                {'url': '/'}]
+            rv = client.get('/apispec.json', base_url='http://bar.com')
+            assert rv.json['servers'] == [{'url': '/'}]
+            assert dumps.call_count == 0
+
+            # only the servers section is serialized for a URL prefix
+            rv = client.get('/apispec.json', base_url='http://foo.com/api/')
+            assert rv.json['servers'] == [{'url': 'http://foo.com/api/'}]
+            assert rv.json['paths'] == apispec['paths']
+            dumps.assert_called_once_with([{'url': 'http://foo.com/api/'}])
+
+    def test_apispec_incremental(self):
+        app, apifairy = self.create_app()
+        auth = HTTPBasicAuth()
+        bp = Blueprint('bp', __name__)
+
+        @app.route('/foo/bar')
+        @response(Schema)
+        def foo():
+            pass
+
+        @bp.route('/foo/bar', methods=['POST'])
+        @authenticate(auth)
+        @body(Schema2)
+        def bar():
+            pass
+
+        @bp.route('/baz')
+        @response(FooSchema)
+        def baz():
+            pass
+
+        apispec = apifairy.build_spec(app)
+        assert list(apispec['paths']) == ['/foo/bar']
+        assert apifairy.apispec is apispec
+        etag = apifairy._apispec_payload.variants['identity'][1]
+
+        app.register_blueprint(bp)
+        client = app.test_client()
+        rv = client.get('/apispec.json', headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        validate_spec(rv.json)
+        assert list(rv.json['paths']) == ['/baz', '/foo/bar']
+        assert list(rv.json['paths']['/foo/bar']) == ['get', 'post']
+        assert rv.json['paths']['/foo/bar']['post']['security'] == [
+            {'basic_auth': []}]
+        assert rv.json['tags'] == [{'name': 'Bp'}]
+        assert set(rv.json['components']['schemas']) == {
+            'Schema', 'Schema2', 'Foo'}
+        assert apifairy.apispec is not apispec
+        assert apifairy._spec_state.endpoints['foo'] == ['/foo/bar']
+        assert apifairy._spec_state.endpoints['bp.bar'] == ['/foo/bar']
+
+        # a full rebuild gives the same result
+        incremental = apifairy.apispec
+        apifairy._apispec = apifairy._spec_state = None
+        with app.app_context():
+            assert apifairy.apispec == incremental
+            assert list(apifairy.apispec['paths']) == ['/baz', '/foo/bar']
+
+    def test_apispec_multiple_rules(self):
+        app, apifairy = self.create_app()
+
+        @app.route('/users', endpoint='users')
+        @app.route('/users/<int:id>', endpoint='users')
+        @response(Schema)
+        def users(id=None):
+            pass
+
+        client = app.test_client()
+        rv = client.get('/apispec.json')
+        assert rv.status_code == 200
+        assert list(rv.json['paths']) == ['/users', '/users/{id}']
+        assert apifairy._spec_state.endpoints['users'] == [
+            '/users', '/users/{id}']
+
+        # a rule added later for an existing endpoint updates the spec
+        app, apifairy = self.create_app()
+        bp = Blueprint('bp', __name__)
+
+        @bp.route('/foo')
+        @response(Schema)
+        def foo():
+            pass
+
+        app.register_blueprint(bp, url_prefix='/v1')
+        apispec = apifairy.build_spec(app)
+        assert list(apispec['paths']) == ['/v1/foo']
+
+        app.add_url_rule('/bar', 'bp.foo')
+        assert list(apifairy.apispec['paths']) == ['/bar', '/v1/foo']
+        app.register_blueprint(bp, url_prefix='/v2', name='bp2')
+        client = app.test_client()
+        rv = client.get('/apispec.json')
+        assert list(rv.json['paths']) == ['/bar', '/v1/foo', '/v2/foo']
+
+    def test_apispec_server_urls(self):
+        app, apifairy = self.create_app(config={
+            'APIFAIRY_APISPEC_CACHE_SIZE': 1})
+
+        @app.route('/foo')
+        @response(Schema)
+        def foo():
+            pass
+
+        client = app.test_client()
+        rv = client.get('/apispec.json', base_url='http://foo.com')
+        assert rv.json['servers'] == [{'url': 'http://foo.com/'}]
+        rv = client.get('/apispec.json', base_url='http://bar.com/api/')
+        assert rv.json['servers'] == [{'url': 'http://bar.com/api/'}]
+        assert rv.json['paths'] == apifairy.apispec['paths']
+        etag = rv.headers['ETag']
+        rv = client.get('/apispec.json', base_url='http://bar.com/api/',
+                        headers={'Accept-Encoding': 'gzip'})
+        assert json.loads(gzip.decompress(rv.data))['servers'] == [
+            {'url': 'http://bar.com/api/'}]
+        rv = client.get('/apispec.json', base_url='http://bar.com/api/')
+        assert rv.headers['ETag'] == etag
+        assert list(apifairy._apispec_payloads) == ['http://bar.com/api/']
+        rv = client.get('/apispec.json', base_url='http://baz.com')
+        assert rv.json['servers'] == [{'url': 'http://baz.com/'}]
+        assert list(apifairy._apispec_payloads) == ['http://baz.com/']
+        rv = client.get('/apispec.json', base_url='http://foo.com')
+        assert rv.json['servers'] == [{'url': 'http://foo.com/'}]
+        assert apifairy.apispec['servers'] == [{'url': 'http://foo.com/'}]
+
+        app, apifairy = self.create_app()
+        apifairy.build_spec(app, server_url='https://example.com/')
+        client = app.test_client()
+        rv = client.get('/apispec.json', base_url='http://bar.com')
+        assert rv.json['servers'] == [{'url': 'https://example.com/'}]
+
+    def test_export(self):
+        app, apifairy = self.create_app()
+
+        @app.route('/foo')
+        @response(Schema)
+        def foo():
+            pass
+
+        runner = app.test_cli_runner()
+        rv = runner.invoke(args=['apifairy', 'export', '--server-url',
+                                 'https://example.com/'])
+        assert rv.exit_code == 0
+        apispec = json.loads(rv.output)
+        validate_spec(apispec)
+        assert apispec['servers'] == [{'url': 'https://example.com/'}]
+        assert '/foo' in apispec['paths']
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'apispec.yaml')
+            rv = runner.invoke(args=['apifairy', 'export', filename])
+            assert rv.exit_code == 0
+            with open(filename) as f:
+                assert 'openapi: 3.0.3' in f.read()
+
+            filename = os.path.join(tmpdir, 'apispec.json')
+            rv = runner.invoke(args=['apifairy', 'export', filename,
+                                     '--indent', '2'])
+            assert rv.exit_code == 0
+            with open(filename) as f:
+                assert f.read().startswith('{\n  "')
+
+    def test_apispec_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filename = os.path.join(tmpdir, 'apispec.json')
+            with open(filename, 'w') as f:
+                f.write('{"openapi": "3.0.3", "paths": {}}')
+            app, apifairy = self.create_app(config={
+                'APIFAIRY_APISPEC_FILE': filename})
+
+            @app.route('/foo')
+            @response(Schema)
+            def foo():
+                pass
+
+            client = app.test_client()
+            rv = client.get('/apispec.json')
+            assert rv.status_code == 200
+            assert rv.data == b'{"openapi": "3.0.3", "paths": {}}'
+            assert 'ETag' in rv.headers
+            assert apifairy.apispec == {'openapi': '3.0.3', 'paths': {}}
+
     def test_custom_apispec_path(self):
         app, _ = self.create_app(config={'APIFAIRY_APISPEC_PATH': '/foo'})
 
@@ -193,6 +506,38 @@ class TestAPIFairy(unittest.TestCase):
         assert b'redoc.standalone.js' not in rv.data
         assert b'swagger-ui-bundle.js' in rv.data
 
+    def test_ui_cache(self):
+        app, _ = self.create_app()
+
+        client = app.test_client()
+        with mock.patch('apifairy.core.render_template',
+                        wraps=render_template) as render:
+            rv = client.get('/docs')
+            assert rv.status_code == 200
+            assert rv.headers['Content-Type'] == 'text/html; charset=utf-8'
+            etag = rv.headers['ETag']
+            rv2 = client.get('/docs')
+            assert rv2.data == rv.data
+            rv = client.get('/docs', headers={'If-None-Match': etag})
+            assert rv.status_code == 304
+            assert render.call_count == 1
+
+            rv = client.get('/docs', base_url='http://localhost/api/')
+            assert rv.status_code == 200
+            assert b'/api/apispec.json' in rv.data
+            assert render.call_count == 2
+            rv = client.get('/docs', base_url='http://localhost/api/')
+            assert render.call_count == 2
+
+        app, _ = self.create_app(config={'TEMPLATES_AUTO_RELOAD': True})
+
+        client = app.test_client()
+        with mock.patch('apifairy.core.render_template',
+                        wraps=render_template) as render:
+            client.get('/docs')
+            client.get('/docs')
+            assert render.call_count == 2
+
     def test_custom_ui_path(self):
         app, _ = self.create_app(config={'APIFAIRY_UI_PATH': '/foo'})
 
@@ -210,6 +555,82 @@ class TestAPIFairy(unittest.TestCase):
         rv = client.get('/docs')
         assert rv.status_code == 404
 
+    def test_ui_assets(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with open(os.path.join(tmpdir, 'redoc.standalone.js'), 'wb') as f:
+                f.write(b'redoc();')
+            with open(os.path.join(tmpdir, 'redoc.standalone.js.gz'),
+                      'wb') as f:
+                f.write(gzip.compress(b'redoc();', mtime=0))
+            app, _ = self.create_app(config={'APIFAIRY_UI_ASSETS': tmpdir})
+
+            client = app.test_client()
+            rv = client.get('/docs')
+            assert rv.status_code == 200
+            assert b'https://' not in rv.data
+            url = '/docs/assets/redoc.standalone.07659f651428.js'
+            assert url.encode() in rv.data
+
+            rv = client.get(url)
+            assert rv.status_code == 200
+            assert rv.data == b'redoc();'
+            assert rv.headers['Content-Type'] == \
+                'text/javascript; charset=utf-8'
+            assert rv.headers['Cache-Control'] == \
+                'public, max-age=31536000, immutable'
+            etag = rv.headers['ETag']
+            rv = client.get(url, headers={'If-None-Match': etag})
+            assert rv.status_code == 304
+            rv = client.get(url, headers={'Accept-Encoding': 'gzip'})
+            assert rv.status_code == 200
+            assert rv.headers['Content-Encoding'] == 'gzip'
+            assert rv.data == gzip.compress(b'redoc();', mtime=0)
+
+            rv = client.get('/docs/assets/redoc.standalone.js')
+            assert rv.status_code == 404
+
+            # files that are not available locally are loaded from the CDN
+            app, _ = self.create_app(config={'APIFAIRY_UI': 'swagger_ui',
+                                             'APIFAIRY_UI_ASSETS': tmpdir})
+            with open(os.path.join(tmpdir, 'swagger-ui.css'), 'wb') as f:
+                f.write(b'body {}')
+
+            client = app.test_client()
+            rv = client.get('/docs')
+            assert rv.status_code == 200
+            assert b'/docs/assets/swagger-ui.' in rv.data
+            assert b'https://unpkg.com/swagger-ui-dist/swagger-ui-bundle.js' \
+                in rv.data
+
+    def test_download_ui(self):
+        app, _ = self.create_app(config={'APIFAIRY_UI': 'elements'})
+
+        def urlopen(url):
+            return BytesIO(url.encode())
+
+        runner = app.test_cli_runner()
+        rv = runner.invoke(args=['apifairy', 'download-ui'])
+        assert rv.exit_code == 1
+        with tempfile.TemporaryDirectory() as tmpdir:
+            with mock.patch('apifairy.cli.urlopen', urlopen):
+                rv = runner.invoke(args=['apifairy', 'download-ui', tmpdir,
+                                         '--ui', 'rapidoc'])
+            assert rv.exit_code == 0
+            assert sorted(os.listdir(tmpdir)) == [
+                'rapidoc-min.js', 'rapidoc-min.js.gz']
+            with open(os.path.join(tmpdir, 'rapidoc-min.js.gz'), 'rb') as f:
+                assert gzip.decompress(f.read()) == \
+                    b'https://unpkg.com/rapidoc/dist/rapidoc-min.js'
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            app.extensions['apifairy'].ui_assets = tmpdir
+            with mock.patch('apifairy.cli.urlopen', urlopen):
+                rv = runner.invoke(args=['apifairy', 'download-ui'])
+            assert rv.exit_code == 0
+            assert sorted(os.listdir(tmpdir)) == [
+                'styles.min.css', 'styles.min.css.gz',
+                'web-components.min.js', 'web-components.min.js.gz']
+
     def test_apispec_ui_decorators(self):
         def auth(f):
             def wrapper(*args, **kwargs):
@@ -360,6 +781,166 @@ class TestAPIFairy(unittest.TestCase):
         assert rv.status_code == 200
         assert rv.json == {'name': None, 'len': 3}
 
+    def test_body_form_stream(self):
+        app, _ = self.create_app()
+
+        class StreamSchema(ma.Schema):
+            name = ma.Str(required=True)
+            file = FileField(required=True, stream=True, max_size=10)
+
+        class LimitSchema(ma.Schema):
+            file = FileField(required=True, max_size=10)
+
+        @app.route('/stream', methods=['POST'])
+        @body(StreamSchema, location='form',
+              media_type='multipart/form-data')
+        def stream(form):
+            assert 'file' not in request.files
+            file = form['file']
+            return {'name': form['name'], 'file': file.read().decode(),
+                    'filename': file.filename}
+
+        @app.route('/limit', methods=['POST'])
+        @body(LimitSchema, location='form')
+        def limit(form):
+            return {'len': len(form['file'].read())}
+
+        client = app.test_client()
+        rv = client.post('/stream', data={
+            'name': 'foo', 'file': (BytesIO(b'bar'), 'test.txt')})
+        assert rv.status_code == 200
+        assert rv.json == {'name': 'foo', 'file': 'bar',
+                           'filename': 'test.txt'}
+
+        rv = client.post('/stream', data={
+            'name': 'foo', 'file': (BytesIO(b'x' * 11), 'test.txt')})
+        assert rv.status_code == 413
+        assert rv.json == {
+            'messages': {'form': {'file': ['File is too large.']}}}
+
+        rv = client.post('/stream', data={'name': 'foo'})
+        assert rv.status_code == 400
+        assert rv.json == {
+            'messages': {
+                'form': {'file': ['Missing data for required field.']}
+            }
+        }
+
+        # malformed requests
+        missing = {'messages': {'form': {
+            'name': ['Missing data for required field.'],
+            'file': ['Missing data for required field.']}}}
+        rv = client.post('/stream', data=b'foo',
+                         content_type='multipart/form-data')
+        assert rv.status_code == 400
+        assert rv.json == missing
+
+        name_part = (b'--xyz\r\nContent-Disposition: form-data; '
+                     b'name="name"\r\n\r\nfoo\r\n')
+        file_part = (b'--xyz\r\nContent-Disposition: form-data; '
+                     b'name="file"; filename="test.txt"\r\n'
+                     b'Content-Type: text/plain\r\n\r\nbar')
+        rv = client.post('/stream', data=name_part[:-10],
+                         content_type='multipart/form-data; boundary=xyz')
+        assert rv.status_code == 400
+        assert rv.json == missing
+
+        rv = client.post('/stream', data=name_part + file_part,
+                         content_type='multipart/form-data; boundary=xyz')
+        assert rv.status_code == 400
+        assert rv.json == {
+            'messages': {'form': {'file': ['Invalid file.']}}}
+
+        rv = client.post('/limit', data={
+            'file': (BytesIO(b'x' * 10), 'test.txt')})
+        assert rv.status_code == 200
+        assert rv.json == {'len': 10}
+
+        rv = client.post('/limit', data={
+            'file': (BytesIO(b'x' * 11), 'test.txt')})
+        assert rv.status_code == 400
+        assert rv.json == {
+            'messages': {'form': {'file': ['File is too large.']}}}
+
+        class TwoStreamsSchema(ma.Schema):
+            file = FileField(stream=True)
+            file2 = FileField(stream=True)
+
+        class StreamFirstSchema(ma.Schema):
+            file = FileField(stream=True)
+            name = ma.Str()
+
+        with pytest.raises(ValueError):
+            body(TwoStreamsSchema, location='form')
+        with pytest.raises(ValueError):
+            body(StreamFirstSchema, location='form')
+
+    def test_body_limits(self):
+        app, _ = self.create_app()
+
+        class LimitedSchema(ma.Schema):
+            class Meta:
+                max_content_length = 30
+                max_items = 2
+
+            name = ma.Str()
+
+        @app.route('/foo', methods=['POST'])
+        @body(Schema, max_content_length=20)
+        def foo(body):
+            return body
+
+        @app.route('/bar', methods=['POST'])
+        @body(LimitedSchema(many=True))
+        def bar(body):
+            return {'len': len(body)}
+
+        client = app.test_client()
+        rv = client.post('/foo', json={'name': 'foo'})
+        assert rv.status_code == 200
+        rv = client.post('/foo', json={'name': 'x' * 20})
+        assert rv.status_code == 413
+        assert rv.json == {
+            'messages': {'json': {'_schema': ['Request body is too large.']}}}
+
+        def post_stream(data):
+            environ = EnvironBuilder(
+                '/foo', method='POST', input_stream=BytesIO(
+                    json.dumps(data).encode()),
+                content_type='application/json').get_environ()
+            del environ['CONTENT_LENGTH']
+            environ['wsgi.input_terminated'] = True
+            return app.response_class.from_app(app, environ)
+
+        rv = post_stream({'name': 'foo'})
+        assert rv.status_code == 200
+        assert rv.json == {'name': 'foo'}
+        rv = post_stream({'name': 'x' * 20})
+        assert rv.status_code == 413
+        assert rv.json == {
+            'messages': {'json': {'_schema': ['Request body is too large.']}}}
+
+        # Flask < 3.1 does not allow the request limit to be changed
+        with mock.patch.object(app.request_class, 'max_content_length',
+                               property(lambda self: None)):
+            rv = post_stream({'name': 'foo'})
+            assert rv.status_code == 200
+            assert rv.json == {'name': 'foo'}
+            rv = post_stream({'name': 'x' * 20})
+            assert rv.status_code == 413
+            assert rv.json == {'messages': {'json': {
+                '_schema': ['Request body is too large.']}}}
+
+        rv = client.post('/bar', json=[{'name': 'a'}, {'name': 'b'}])
+        assert rv.status_code == 200
+        assert rv.json == {'len': 2}
+        rv = client.post('/bar', json=[{}, {}, {}])
+        assert rv.status_code == 413
+        assert rv.json == {
+            'messages': {'json': {'_schema': ['Too many items.']}}}
+        rv = client.post('/bar', json=[{'name': 'x' * 30}])
+        assert rv.status_code == 413
+
     def test_body_custom_error_handler(self):
         app, apifairy = self.create_app()
 
@@ -397,7 +978,8 @@ class TestAPIFairy(unittest.TestCase):
         assert rv.status_code == 400
         assert rv.json == {
             'messages': {
-                'query': {'name': ['Missing data for required field.']}
+                'query': {'name': ['Missing data for required field.'],
+                          'name2': ['Missing data for required field.']}
             }
         }
 
@@ -472,6 +1054,396 @@ class TestAPIFairy(unittest.TestCase):
         assert rv.json == {'id': 123, 'name': 'foo'}
         assert 'Location' not in rv.headers
 
+    def test_response_json_encoder(self):
+        encoded = []
+
+        def encoder(data):
+            encoded.append(data)
+            return json.dumps(data).encode()
+
+        for json_encoder in [encoder, 'orjson.dumps']:
+            app, _ = self.create_app(config={
+                'APIFAIRY_JSON_ENCODER': json_encoder})
+
+            @app.route('/foo')
+            @response(Schema())
+            def foo():
+                return {'name': 'bar'}
+
+            @app.route('/bar')
+            @response(Schema(many=True), status_code=201)
+            def bar():
+                return [{'name': 'foo'}, {'id': 1, 'name': 'bar'}], \
+                    {'X-Foo': 'bar'}
+
+            client = app.test_client()
+
+            rv = client.get('/foo')
+            assert rv.status_code == 200
+            assert rv.headers['Content-Type'] == 'application/json'
+            assert rv.json == {'id': 123, 'name': 'bar'}
+
+            rv = client.get('/bar')
+            assert rv.status_code == 201
+            assert rv.headers['Content-Type'] == 'application/json'
+            assert rv.headers['X-Foo'] == 'bar'
+            assert rv.json == [{'id': 123, 'name': 'foo'},
+                               {'id': 1, 'name': 'bar'}]
+
+        assert encoded == [
+            {'id': 123, 'name': 'bar'},
+            [{'id': 123, 'name': 'foo'}, {'id': 1, 'name': 'bar'}],
+        ]
+
+    def test_compile_schema(self):
+        class Obj:
+            def __init__(self, **kwargs):
+                self.__dict__.update(kwargs)
+
+        data = [
+            {'id': '1', 'cost': 2, 'code': b'abc', 'owner': {'name': 'foo'},
+             'children': [{'id2': 3, 'name2': 'bar'}], 'secret': 'x',
+             'parent': {'name': 'baz'}, 'flag': 'false'},
+            {'id': None, 'owner': None, 'children': []},
+            Obj(id=2, cost=1.5, code='x', owner=Obj(id=4, name='foo'),
+                children=[Obj(id2=5)], parent=Obj(name='bar'), flag=1,
+                get=lambda *args: []),
+        ]
+        for schema in [NestedSchema(), NestedSchema(only=['id', 'owner']),
+                       Schema(), FooSchema(many=True)]:
+            dump = compile_schema(schema)
+            assert dump is not None
+            if schema.many:
+                assert dump([{'name': 'foo'}, {'id': 2}]) == schema.dump(
+                    [{'name': 'foo'}, {'id': 2}])
+            else:
+                for obj in data:
+                    assert dump(obj) == schema.dump(obj)
+                assert dump(data, many=True) == schema.dump(data, many=True)
+        assert compile_schema(HookSchema()) is None
+
+    def test_compile_loader(self):
+        class Color(Enum):
+            red = 1
+            blue = 2
+
+        class SearchSchema(ma.Schema):
+            q = ma.Str(required=True, validate=validate.Length(max=5))
+            page = ma.Int(load_default=1, data_key='p')
+            price = ma.Float(attribute='max_price')
+            exact = ma.Bool()
+            color = ma.Enum(Color)
+            tags = ma.List(ma.Int())
+
+        schema = SearchSchema()
+        load = compile_loader(schema)
+        assert load is not None
+        for query in ['q=foo', 'q=foo&p=3&price=1.5&exact=yes&color=red&x=y',
+                      'q=foo&tags=1&tags=2', 'q=toolong&p=x', '', 'q=a&q=b',
+                      'q=a&exact=maybe&color=green&tags=1&tags=x']:
+            with self.create_app()[0].test_request_context('/?' + query):
+                try:
+                    expected = parser.parse(schema, location='query')
+                except ValidationError as error:
+                    expected = error.messages
+                try:
+                    result = parser.parse_all([
+                        (schema, 'query', {'loader': load})])[0]
+                except ValidationError as error:
+                    result = error.messages
+                assert result == expected
+
+        class LoadHookSchema(ma.Schema):
+            name = ma.Str()
+
+            @post_load
+            def add_id(self, data, **kwargs):
+                return {'id': 1, **data}
+
+        assert compile_loader(LoadHookSchema()) is None
+        assert compile_loader(NestedSchema()) is None
+
+    def test_arguments_compiled(self):
+        app, _ = self.create_app()
+
+        @app.route('/foo')
+        @arguments(QuerySchema, compiled=True)
+        @response(QuerySchema)
+        def foo(query):
+            return query
+
+        client = app.test_client()
+        rv = client.get('/foo?id=3&x=y')
+        assert rv.status_code == 200
+        assert rv.json == {'id': 3}
+        rv = client.get('/foo?id=x')
+        assert rv.status_code == 400
+        assert rv.json == {
+            'messages': {'query': {'id': ['Not a valid integer.']}}}
+
+    def test_response_compiled(self):
+        app, _ = self.create_app()
+
+        @app.route('/foo')
+        @response(NestedSchema(many=True), compiled=True)
+        def foo():
+            return [{'id': 1, 'code': 'foo', 'owner': {'name': 'bar'}}]
+
+        @app.route('/bar')
+        @response(HookSchema, compiled=True)
+        def bar():
+            return {'name': 'bar'}, 201
+
+        client = app.test_client()
+        rv = client.get('/foo')
+        assert rv.status_code == 200
+        assert rv.json == [{'id': 1, 'Code': 'foo', 'total': 0,
+                            'owner': {'id': 123, 'name': 'bar'}}]
+
+        rv = client.get('/bar')
+        assert rv.status_code == 201
+        assert rv.json == {'name': 'BAR'}
+
+    def test_response_stream(self):
+        app, apifairy = self.create_app()
+
+        @app.route('/foo')
+        @response(Schema(many=True), stream=True, chunk_size=2)
+        def foo():
+            return ({'id': i, 'name': f'foo{i}'} for i in range(5))
+
+        @app.route('/bar')
+        @response(Schema(many=True), status_code=201, stream=True,
+                  compiled=True)
+        def bar():
+            return [], {'X-Foo': 'bar'}
+
+        client = app.test_client()
+        rv = client.get('/foo')
+        assert rv.status_code == 200
+        assert rv.is_streamed
+        assert rv.headers['Content-Type'] == 'application/json'
+        assert rv.json == [{'id': i, 'name': f'foo{i}'} for i in range(5)]
+
+        rv = client.get('/foo', headers={'Accept': 'application/x-ndjson'})
+        assert rv.status_code == 200
+        assert rv.headers['Content-Type'] == 'application/x-ndjson'
+        lines = rv.data.decode().split('\n')
+        assert lines[-1] == ''
+        assert [json.loads(line) for line in lines[:-1]] == [
+            {'id': i, 'name': f'foo{i}'} for i in range(5)]
+
+        rv = client.get('/bar')
+        assert rv.status_code == 201
+        assert rv.headers['X-Foo'] == 'bar'
+        assert rv.json == []
+
+        rv = client.get('/apispec.json')
+        validate_spec(rv.json)
+        content = rv.json['paths']['/foo']['get']['responses']['200'][
+            'content']
+        assert content == {
+            'application/json': {'schema': {
+                'type': 'array',
+                'items': {'$ref': '#/components/schemas/Schema'}}},
+            'application/x-ndjson': {'schema': {
+                '$ref': '#/components/schemas/Schema'}},
+        }
+
+        with pytest.raises(ValueError):
+            response(Schema, stream=True)
+
+    def test_paginated_response(self):
+        app, apifairy = self.create_app()
+        items = [{'id': i, 'name': f'foo{i}'} for i in range(1, 6)]
+
+        class Item:
+            def __init__(self, id, name):
+                self.id = id
+                self.name = name
+
+        @app.route('/foo')
+        @paginated_response(Schema, limit=2, max_limit=3)
+        def foo():
+            return (item for item in items)
+
+        @app.route('/bar')
+        @paginated_response(Schema, descending=True, status_code=201,
+                            compiled=True)
+        def bar():
+            return [Item(**item) for item in reversed(items)], \
+                {'X-Foo': 'bar'}
+
+        client = app.test_client()
+        rv = client.get('/foo')
+        assert rv.status_code == 200
+        assert rv.json['data'] == items[:2]
+        cursor = rv.json['pagination']['next_cursor']
+        assert rv.json['pagination'] == {'limit': 2, 'next_cursor': cursor}
+        rv = client.get('/foo?cursor=' + cursor)
+        assert rv.json['data'] == items[2:4]
+        cursor = rv.json['pagination']['next_cursor']
+        rv = client.get('/foo?cursor=' + cursor)
+        assert rv.json == {'data': items[4:],
+                           'pagination': {'limit': 2, 'next_cursor': None}}
+        rv = client.get('/foo?limit=3&cursor=' + cursor)
+        assert rv.json['data'] == items[4:]
+        assert rv.json['pagination'] == {'limit': 3, 'next_cursor': None}
+        rv = client.get('/foo?cursor=' + encode_cursor(5))
+        assert rv.json['data'] == []
+        rv = client.get('/foo?cursor=' + encode_cursor('abc'))
+        assert rv.status_code == 400
+        assert rv.json == {'messages': {'query': {
+            'cursor': ['Invalid cursor.']}}}
+
+        rv = client.get('/foo?limit=4&cursor=foo')
+        assert rv.status_code == 400
+        assert rv.json == {'messages': {'query': {
+            'limit': ['Must be greater than or equal to 1 and less than or '
+                      'equal to 3.'],
+            'cursor': ['Invalid cursor.']}}}
+
+        rv = client.get('/bar?limit=3')
+        assert rv.status_code == 201
+        assert rv.headers['X-Foo'] == 'bar'
+        assert rv.json['data'] == items[:1:-1]
+        cursor = rv.json['pagination']['next_cursor']
+        rv = client.get('/bar?limit=3&cursor=' + cursor)
+        assert rv.json['data'] == items[1::-1]
+        assert rv.json['pagination']['next_cursor'] is None
+
+        rv = client.get('/apispec.json')
+        validate_spec(rv.json)
+        operation = rv.json['paths']['/foo']['get']
+        assert [(p['name'], p['schema']) for p in operation['parameters']] \
+            == [('limit', {'type': 'integer', 'default': 2, 'minimum': 1,
+                           'maximum': 3}),
+                ('cursor', {'type': 'string'})]
+        assert operation['responses']['200']['content'] == {
+            'application/json': {'schema': {
+                '$ref': '#/components/schemas/SchemaPage'}}}
+        assert rv.json['paths']['/bar']['get']['responses']['201'][
+            'content']['application/json']['schema'] == {
+                '$ref': '#/components/schemas/SchemaPage'}
+        schemas = rv.json['components']['schemas']
+        assert 'SchemaPage1' not in schemas
+        assert schemas['SchemaPage']['properties'] == {
+            'data': {'type': 'array',
+                     'items': {'$ref': '#/components/schemas/Schema'}},
+            'pagination': {'$ref': '#/components/schemas/Pagination'}}
+        assert list(schemas['Pagination']['properties']) == [
+            'limit', 'next_cursor']
+
+        with pytest.raises(ValueError):
+            paginated_response(Schema(many=True))
+
+    def test_paginated_response_arguments(self):
+        app, apifairy = self.create_app()
+        calls = []
+
+        @app.route('/foo')
+        @arguments(QuerySchema)
+        @paginated_response(Schema, limit=2, max_limit=3)
+        def foo(query):
+            calls.append(query)
+            return [{'id': i, 'name': 'foo'} for i in range(query['id'])]
+
+        client = app.test_client()
+        rv = client.get('/foo?id=5&limit=3')
+        assert rv.status_code == 200
+        assert [item['id'] for item in rv.json['data']] == [0, 1, 2]
+        assert calls == [{'id': 5}]
+
+        rv = client.get('/foo?id=x&limit=1000&cursor=foo')
+        assert rv.status_code == 400
+        assert rv.json == {'messages': {'query': {
+            'id': ['Not a valid integer.'],
+            'limit': ['Must be greater than or equal to 1 and less than or '
+                      'equal to 3.'],
+            'cursor': ['Invalid cursor.']}}}
+        rv = client.get('/foo?limit=1000')
+        assert rv.status_code == 400
+        assert len(calls) == 1
+
+        rv = client.get('/apispec.json')
+        assert [p['name'] for p in rv.json['paths']['/foo']['get'][
+            'parameters']] == ['limit', 'cursor', 'id']
+
+    def test_paginated_response_sqlalchemy(self):
+        sqlalchemy = pytest.importorskip('sqlalchemy')
+        from sqlalchemy.orm import declarative_base, Session
+
+        Base = declarative_base()
+
+        class User(Base):
+            __tablename__ = 'users'
+            id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True)
+            name = sqlalchemy.Column(sqlalchemy.String)
+            balance = sqlalchemy.Column(sqlalchemy.Numeric(10, 2))
+
+        engine = sqlalchemy.create_engine('sqlite://')
+        Base.metadata.create_all(engine)
+        session = Session(engine)
+        session.add_all([User(id=i, name=f'foo{i}',
+                              balance=Decimal(f'{6 - i}.50'))
+                         for i in range(1, 6)])
+        session.commit()
+        app, apifairy = self.create_app()
+
+        @app.route('/foo')
+        @paginated_response(Schema, limit=2)
+        def foo():
+            return session.query(User).order_by(User.name.desc())
+
+        @app.route('/bar')
+        @paginated_response(Schema, limit=3, descending=True)
+        def bar():
+            return session.query(User)
+
+        @app.route('/baz')
+        @paginated_response(Schema, key='balance', limit=2)
+        def baz():
+            return session.query(User)
+
+        client = app.test_client()
+        rv = client.get('/foo')
+        assert [item['id'] for item in rv.json['data']] == [1, 2]
+        rv = client.get('/foo?cursor=' +
+                        rv.json['pagination']['next_cursor'])
+        assert [item['id'] for item in rv.json['data']] == [3, 4]
+        rv = client.get('/bar')
+        assert [item['id'] for item in rv.json['data']] == [5, 4, 3]
+        rv = client.get('/bar?cursor=' +
+                        rv.json['pagination']['next_cursor'])
+        assert [item['id'] for item in rv.json['data']] == [2, 1]
+        assert rv.json['pagination']['next_cursor'] is None
+        rv = client.get('/bar?cursor=' + encode_cursor('abc'))
+        assert rv.status_code == 400
+        assert rv.json == {'messages': {'query': {
+            'cursor': ['Invalid cursor.']}}}
+        rv = client.get('/baz')
+        assert [item['id'] for item in rv.json['data']] == [5, 4]
+        rv = client.get('/baz?cursor=' +
+                        rv.json['pagination']['next_cursor'])
+        assert [item['id'] for item in rv.json['data']] == [3, 2]
+
+    def test_pagination_cursor(self):
+        for value in [1, 'foo', None, 1.5, datetime(2024, 1, 2, 3, 4, 5),
+                      date(2024, 1, 2), Decimal('1.50'),
+                      UUID('12345678-1234-5678-1234-567812345678')]:
+            assert decode_cursor(encode_cursor(value)) == value
+        assert str(decode_cursor(encode_cursor(Decimal('1.50')))) == '1.50'
+        for cursor in ['', 'foo', encode_cursor(1)[:-1], 'WyJmb28iLDFd',
+                       encode_cursor(Decimal('NaN')), 'WyJkZWNpbWFsIiwieCJd']:
+            with pytest.raises(ValueError):
+                decode_cursor(cursor)
+
+        items = [{'id': 1}, {'id': None}, {'id': 3}]
+        with pytest.raises(TypeError):
+            paginate(items, 'id', 2, cursor=1)
+        with pytest.raises(ValidationError):
+            paginate(items, 'id', 2, cursor='abc')
+
     def test_basic_auth(self):
         app, _ = self.create_app()
         auth = HTTPBasicAuth()
@@ -665,6 +1637,82 @@ class TestAPIFairy(unittest.TestCase):
         assert 'Schema2' in apispec['components']['schemas']
         assert 'Foo' in apispec['components']['schemas']
 
+    def test_apispec_schema_cache(self):
+        app, apifairy = self.create_app()
+        instances = []
+
+        class ErrorSchema(ma.Schema):
+            message = ma.String()
+
+            def __init__(self, *args, **kwargs):
+                instances.append(self)
+                super().__init__(*args, **kwargs)
+
+        @app.route('/foo')
+        @response(Schema, headers=HeaderSchema)
+        @other_responses({400: ErrorSchema, 404: ErrorSchema})
+        def foo():
+            pass
+
+        @app.route('/bar')
+        @response(Schema(many=True), headers=HeaderSchema)
+        @other_responses({400: ErrorSchema})
+        def bar():
+            pass
+
+        with app.test_request_context():
+            apispec = apifairy.apispec
+        assert len(instances) == 1
+        assert list(apispec['components']['schemas']) == ['Schema', 'Error']
+        responses1 = apispec['paths']['/foo']['get']['responses']
+        responses2 = apispec['paths']['/bar']['get']['responses']
+        assert responses1['200']['content']['application/json']['schema'] == {
+            '$ref': '#/components/schemas/Schema'}
+        assert responses2['200']['content']['application/json']['schema'] == {
+            'type': 'array', 'items': {'$ref': '#/components/schemas/Schema'}}
+        assert responses1['200']['headers'] == responses2['200']['headers']
+        assert 'X-Token' in responses1['200']['headers']
+        assert responses1['404']['content'] == responses2['400']['content']
+
+    def test_apispec_prune_components(self):
+        for prune in [False, True]:
+            app, apifairy = self.create_app(config={
+                'APIFAIRY_PRUNE_COMPONENTS': prune})
+            auth = HTTPBasicAuth()
+
+            @apifairy.process_apispec
+            def remove_private(apispec):
+                del apispec['paths']['/private']
+                return apispec
+
+            @app.route('/foo')
+            @response(NestedSchema)
+            def foo():
+                pass
+
+            @app.route('/private')
+            @authenticate(auth)
+            @body(Schema)
+            @response(HookSchema)
+            def private():
+                pass
+
+            with app.test_request_context():
+                apispec = apifairy.apispec
+            validate_spec(apispec)
+            assert list(apispec['paths']) == ['/foo']
+            if prune:
+                assert apispec['components'] == {'schemas': {
+                    'Foo': apispec['components']['schemas']['Foo'],
+                    'Schema2': apispec['components']['schemas']['Schema2'],
+                    'Nested': apispec['components']['schemas']['Nested'],
+                }}
+            else:
+                assert set(apispec['components']['schemas']) == {
+                    'Foo', 'Schema2', 'Nested', 'Schema', 'Hook'}
+                assert 'basic_auth' in apispec['components'][
+                    'securitySchemes']
+
     def test_endpoints(self):
         app, apifairy = self.create_app()
 
@@ -975,6 +2023,86 @@ class TestAPIFairy(unittest.TestCase):
         assert rv.json['paths']['/parent/child/']['get'][
             'tags'] == ['Parent.Child']
 
+    def test_apispec_split(self):
+        app, apifairy = self.create_app(config={
+            'APIFAIRY_APISPEC_SPLIT': True,
+            'APIFAIRY_TAGS': ['users', 'orders']})
+        auth = HTTPBasicAuth()
+        orders_bp = Blueprint('orders', __name__)
+        users_bp = Blueprint('users', __name__)
+
+        @orders_bp.route('/orders')
+        @authenticate(auth)
+        @response(NestedSchema)
+        def get_orders():
+            pass
+
+        @users_bp.route('/users')
+        @body(Schema)
+        @response(Schema)
+        def new_user():
+            pass
+
+        @app.route('/health')
+        def health():
+            pass
+
+        app.register_blueprint(orders_bp)
+        app.register_blueprint(users_bp)
+        client = app.test_client()
+
+        rv = client.get('/apispec/index.json')
+        assert rv.status_code == 200
+        assert rv.json == {
+            'info': {'title': 'Foo', 'version': '1.0'},
+            'tags': [{'name': 'Users', 'url': '/apispec/Users.json'},
+                     {'name': 'Orders', 'url': '/apispec/Orders.json'}],
+        }
+
+        rv = client.get('/apispec/Orders.json')
+        assert rv.status_code == 200
+        validate_spec(rv.json)
+        assert rv.json['servers'] == [{'url': 'http://localhost/'}]
+        assert rv.json['tags'] == [{'name': 'Orders'}]
+        assert list(rv.json['paths']) == ['/orders']
+        assert list(rv.json['components']['schemas']) == [
+            'Foo', 'Schema2', 'Nested']
+        assert list(rv.json['components']['securitySchemes']) == [
+            'basic_auth']
+        etag = rv.headers['ETag']
+        rv = client.get('/apispec/Orders.json',
+                        headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+
+        rv = client.get('/apispec/Users.json')
+        assert rv.status_code == 200
+        validate_spec(rv.json)
+        assert list(rv.json['paths']) == ['/users']
+        assert list(rv.json['components']) == ['schemas']
+        assert list(rv.json['components']['schemas']) == ['Schema']
+
+        rv = client.get('/apispec/Foo.json')
+        assert rv.status_code == 404
+
+        rv = client.get('/docs')
+        assert rv.status_code == 200
+        assert b'spec-url="/apispec.json"' in rv.data
+        assert b'<option value="Orders">Orders</option>' in rv.data
+        rv = client.get('/docs?tag=Orders')
+        assert rv.status_code == 200
+        assert b'spec-url="/apispec/Orders.json"' in rv.data
+        assert b'<option value="Orders" selected>Orders</option>' in rv.data
+        rv = client.get('/docs?tag=')
+        assert rv.status_code == 200
+        assert b'spec-url="/apispec.json"' in rv.data
+        rv = client.get('/docs?tag=Foo')
+        assert rv.status_code == 404
+
+        # the split specs are generated again when the spec changes
+        apifairy.build_spec(app, server_url='https://example.com/')
+        rv = client.get('/apispec/Orders.json')
+        assert rv.json['servers'] == [{'url': 'https://example.com/'}]
+
     def test_async_views(self):
         if not sys.version_info >= (3, 7):
             pytest.skip('This test requires Python 3.7 or higher.')
@@ -1038,6 +2166,228 @@ class TestAPIFairy(unittest.TestCase):
         assert rv.status_code == 200
         assert rv.json == {'id': 2, 'name': 'foo'}
 
+    def test_async_views_native(self):
+        app, apifairy = self.create_app()
+
+        async def foo(query, body):
+            return {'id': query['id'], 'name': body['name']}
+
+        def bar(query):
+            return {'id': query['id'], 'name': 'bar'}
+
+        async_view = arguments(QuerySchema)(body(Schema)(response(Schema)(
+            other_responses({404: 'foo not found'})(foo))))
+        sync_view = other_responses({404: 'bar not found'})(bar)
+        assert iscoroutinefunction(async_view)
+        assert sync_view is bar
+        app.add_url_rule('/foo', view_func=async_view, methods=['POST'])
+        app.add_url_rule('/bar', view_func=arguments(QuerySchema)(
+            response(Schema)(sync_view)))
+
+        client = app.test_client()
+        rv = client.post('/foo?id=3', json={'name': 'john'})
+        assert rv.status_code == 200
+        assert rv.json == {'id': 3, 'name': 'john'}
+        rv = client.post('/foo', json={})
+        assert rv.status_code == 400
+        rv = client.get('/bar?id=2')
+        assert rv.status_code == 200
+        assert rv.json == {'id': 2, 'name': 'bar'}
+
+    def test_dispatcher(self):
+        app, apifairy = self.create_app()
+
+        class HeaderSchema(ma.Schema):
+            x = ma.Str(data_key='X-Foo')
+
+        def foo(query, headers, body, id):
+            return {'id': query['id'] + id,
+                    'name': headers['x'] + body['name']}
+
+        view = response(Schema, status_code=201)(foo)
+        partial_view = view
+        view = arguments(QuerySchema)(arguments(HeaderSchema(
+            unknown=EXCLUDE), location='headers')(body(Schema)(view)))
+        assert view.__wrapped__ is foo
+        assert len(view._inputs) == 3
+        assert partial_view._inputs == ()
+        app.add_url_rule('/foo/<int:id>', view_func=view, methods=['POST'])
+
+        auth = HTTPBasicAuth()
+
+        @auth.verify_password
+        def verify_password(username, password):
+            return username == 'foo'
+
+        @app.route('/bar', methods=['POST'])
+        @arguments(QuerySchema)
+        @authenticate(auth)
+        @body(Schema, as_kwargs=True)
+        @response(Schema)
+        def bar(query, body, name):
+            return {'id': query['id'], 'name': name}
+
+        client = app.test_client()
+        rv = client.post('/foo/2?id=3', json={'name': 'john'},
+                         headers={'X-Foo': 'hi '})
+        assert rv.status_code == 201
+        assert rv.json == {'id': 5, 'name': 'hi john'}
+        rv = client.post('/foo/2?id=3', json={})
+        assert rv.status_code == 400
+        assert rv.json['messages'] == {
+            'json': {'name': ['Missing data for required field.']}}
+        rv = client.post('/bar', json={'name': 'john'})
+        assert rv.status_code == 401
+        rv = client.post('/bar?id=4', json={'name': 'john'},
+                         headers={'Authorization': 'Basic Zm9vOmJhcg=='})
+        assert rv.status_code == 200
+        assert rv.json == {'id': 4, 'name': 'john'}
+
+        paths = client.get('/apispec.json').json['paths']
+        assert [p['name'] for p in paths['/foo/{id}']['post']['parameters']] \
+            == ['id', 'X-Foo', 'id']
+        assert 'requestBody' in paths['/bar']['post']
+
+    def test_parse_all_errors(self):
+        app, _ = self.create_app()
+
+        class HeaderSchema(ma.Schema):
+            x = ma.Int(data_key='X-Foo')
+
+        @app.route('/foo', methods=['POST'])
+        @arguments(QuerySchema)
+        @arguments(HeaderSchema, location='headers')
+        @body(Schema, error_status_code=422)
+        def foo(query, headers, body):
+            return {}
+
+        client = app.test_client()
+        rv = client.post('/foo?id=x', json={}, headers={'X-Foo': 'y'})
+        assert rv.status_code == 400
+        assert rv.json == {
+            'messages': {
+                'query': {'id': ['Not a valid integer.']},
+                'headers': {'X-Foo': ['Not a valid integer.']},
+                'json': {'name': ['Missing data for required field.']},
+            }
+        }
+        rv = client.post('/foo', json={})
+        assert rv.status_code == 422
+        assert rv.json == {
+            'messages': {
+                'json': {'name': ['Missing data for required field.']},
+            }
+        }
+
+        with app.test_request_context('/?id=2'):
+            assert parser.parse_all([(QuerySchema(), 'query', {}),
+                                     (QuerySchema(), 'json', {})]) == \
+                [{'id': 2}, {'id': 1}]
+
+    def test_parse_all_webargs_internals(self):
+        # parse_all() uses private methods of the webargs parser, so any
+        # changes to them in a new webargs release must be detected
+        methods = {
+            '_prepare_for_parse': ['argmap', 'req', 'location', 'unknown',
+                                   'validate'],
+            '_load_location_data': ['schema', 'req', 'location'],
+            '_process_location_data': ['location_data', 'schema', 'req',
+                                       'location', 'unknown', 'validators'],
+            '_makeproxy': ['multidict', 'schema'],
+        }
+        for name, params in methods.items():
+            assert list(signature(getattr(FlaskParser, name)).parameters)[
+                1:len(params) + 1] == params, name
+
+    def test_metrics(self):
+        app, apifairy = self.create_app()
+        metrics = []
+
+        @apifairy.metrics_handler
+        def record(endpoint, timings):
+            metrics.append((endpoint, timings))
+
+        @app.route('/foo', methods=['POST'])
+        @arguments(QuerySchema)
+        @body(Schema)
+        @response(Schema)
+        def foo(query, body):
+            if query['id'] == 0:
+                abort(404)
+            return body
+
+        @app.route('/bar')
+        @other_responses({404: 'Not found'})
+        def bar():
+            return 'bar'
+
+        client = app.test_client()
+        rv = client.post('/foo', json={'name': 'foo'})
+        assert rv.status_code == 200
+        assert [m[0] for m in metrics] == ['foo']
+        assert sorted(metrics[0][1]) == [
+            'arguments', 'body', 'handler', 'response']
+        assert all(t >= 0 for t in metrics[0][1].values())
+
+        rv = client.post('/foo', json={})
+        assert rv.status_code == 400
+        assert sorted(metrics[1][1]) == ['arguments', 'body']
+        rv = client.post('/foo?id=0', json={'name': 'foo'})
+        assert rv.status_code == 404
+        assert sorted(metrics[2][1]) == ['arguments', 'body', 'handler']
+
+        rv = client.get('/bar')
+        assert rv.status_code == 200
+        assert len(metrics) == 3
+
+        apifairy.metrics_callback = None
+        rv = client.post('/foo', json={'name': 'foo'})
+        assert rv.status_code == 200
+        assert len(metrics) == 3
+
+    def test_metrics_multiple_dispatchers(self):
+        app, apifairy = self.create_app()
+        auth = HTTPBasicAuth()
+        metrics = []
+
+        @apifairy.metrics_handler
+        def record(endpoint, timings):
+            metrics.append((endpoint, timings))
+
+        @auth.verify_password
+        def verify_password(username, password):
+            return username == 'foo'
+
+        @app.route('/foo', methods=['POST'])
+        @arguments(QuerySchema)
+        @authenticate(auth)
+        @body(Schema)
+        @response(Schema)
+        def foo(query, body):
+            if query['id'] == 0:
+                abort(404)
+            return body
+
+        client = app.test_client()
+        headers = {'Authorization': 'Basic Zm9vOmJhcg=='}
+        rv = client.post('/foo', json={'name': 'foo'}, headers=headers)
+        assert rv.status_code == 200
+        assert [m[0] for m in metrics] == ['foo']
+        assert sorted(metrics[0][1]) == [
+            'arguments', 'body', 'handler', 'response']
+        assert all(t >= 0 for t in metrics[0][1].values())
+
+        rv = client.post('/foo', json={}, headers=headers)
+        assert rv.status_code == 400
+        assert sorted(metrics[1][1]) == ['arguments', 'body']
+        rv = client.post('/foo?id=0', json={'name': 'foo'}, headers=headers)
+        assert rv.status_code == 404
+        assert sorted(metrics[2][1]) == ['arguments', 'body', 'handler']
+        rv = client.post('/foo', json={'name': 'foo'})
+        assert rv.status_code == 401
+        assert sorted(metrics[3][1]) == ['arguments', 'handler']
+        assert len(metrics) == 4
+
     def test_webhook(self):
         app, apifairy = self.create_app()
         bp = Blueprint('bp', __name__)